@@ -1,12 +1,24 @@
 """
 Read raw dump files, extract certain domains only and aggregate hourly data to daily data.
+
+The pre-aggregated data of every hourly file is cached in `path_partials` ({day}/{file}.parquet), along with the
+size and modification time of the hourly files that went into each day, per output format ({day}/hours_csv.json).
+When an hourly file of an aggregated day arrives late or is downloaded again, only this file is parsed and the day is
+summed again from the cached partial aggregates.
 """
 
+import numpy as np
 import pandas as pd
 from pandas.errors import ParserError
-from download_dumps import path_data
+from download_dumps import path_data, open_catalog
+import dump_store
+from dump_parser import BadLines, parse_dump_file
 import os
-from concurrent.futures import ThreadPoolExecutor
+import io
+import gzip
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import multiprocessing
 from time import time
 
@@ -16,12 +28,65 @@ keep_domains = [
 ]
 
 path_aggreg = '/media/maousi/Raw/ada-wiki/aggreg'
+path_partials = '/media/maousi/Raw/ada-wiki/partials'
+
+# csv: one gzip-compressed .csv file per day in `path_aggreg`
+# parquet: one Parquet file per domain and day in `dump_store.path_store`
+output_formats = ['csv', 'parquet']
+
+read_chunk_size = 2**24
+
+# arrow: dump_parser.py, multithreaded and robust to malformed lines
+# pandas: read_dump_file, pandas.read_csv
+parsers = ['arrow', 'pandas']
+parser = 'arrow'
+
+
+def find_lines(buffer, prefixes, kept):
+    """Append to `kept` the lines of `buffer` starting with one of `prefixes` (which start with a line break).
+    bytes.find only stops on the kept lines, instead of looping over every line in Python."""
+    for prefix in prefixes:
+        start = buffer.find(prefix)
+        while start != -1:
+            end = buffer.find(b'\n', start + 1)
+            kept.append(buffer[start + 1:end])
+            start = buffer.find(prefix, end)
+
+
+def filter_dump_lines(fp, domains):
+    """Decompress the dump file by chunks and keep the raw lines of the given domains only,
+    return them as a single bytes object. Lines start with the domain followed by a space."""
+    prefixes = [f'\n{domain} '.encode('utf-8') for domain in domains]
+    kept = []
+    # Every buffer starts and ends with a line break, such that all lines are matched the same way
+    rest = b'\n'
+    with gzip.open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(read_chunk_size), b''):
+            cut = chunk.rfind(b'\n') + 1
+            if cut == 0:
+                rest += chunk
+                continue
+            find_lines(rest + chunk[:cut], prefixes, kept)
+            # The last line of the chunk is incomplete, it goes with the next chunk
+            rest = b'\n' + chunk[cut:]
+    find_lines(rest + b'\n', prefixes, kept)
+    return b'\n'.join(kept + [b'']) if kept else b''
+
+
+def read_dump_file(fp, domains=None):
+    """Load gzip-compressed csv file, only the lines of `domains` if given (all domains by default)"""
+    if domains is not None:
+        # Only the few kept domains are parsed, most lines are discarded before reaching pandas
+        lines = filter_dump_lines(fp, domains)
+        if len(lines) == 0:
+            return pd.DataFrame({'domain': [], 'article': [], 'views': []})
+        fp = io.BytesIO(lines)
+        compression = None
+    else:
+        compression = 'gzip'
 
-
-def read_dump_file(fp):
-    """Load gzip-compressed csv file"""
     df = pd.read_csv(fp,
-                     compression='gzip',
+                     compression=compression,
                      sep=' ',
                      header=None,
                      usecols=[0,1,2],
@@ -42,10 +107,24 @@ def read_dump_file(fp):
     return df
 
 
+def parse_dump(fp, domains=None):
+    """Load dump file with dump_parser.py, only the lines of `domains` if given (all domains by default).
+    Malformed lines are skipped with a warning."""
+    bad_lines = BadLines()
+    df = parse_dump_file(fp, domains, bad_lines)
+    if bad_lines.count > 0:
+        example = f', e.g. {bad_lines.examples[0]!r}' if bad_lines.examples else ''
+        print(f'<WARNING> skipped {bad_lines.count} malformed lines of {fp}{example}')
+    return df
+
+
 def process_dump_file(fp):
     """Load dump file, keep only domains specified in `keep_domains`,
     remove items where article name or domain is missing."""
-    df = read_dump_file(fp)
+    if parser == 'arrow':
+        df = parse_dump(fp, keep_domains)
+    else:
+        df = read_dump_file(fp, keep_domains)
     print('Loaded', fp)
 
     df = df[df.domain.isin(keep_domains)]
@@ -53,6 +132,82 @@ def process_dump_file(fp):
     return df
 
 
+def preaggregate_dump_file(fp):
+    """process_dump_file, then sum the views of duplicated (domain, article) rows.
+    Run in worker processes: the result is smaller to send back to the main process."""
+    df = process_dump_file(fp)
+    parts = []
+    for domain, sub in df.groupby('domain', sort=False):
+        # Sum on integer codes of the articles of the file, rather than on the names
+        codes, articles = pd.factorize(sub.article)
+        views = np.bincount(codes, weights=sub.views.values, minlength=len(articles))
+        parts.append(pd.DataFrame({'domain': domain, 'article': articles, 'views': views.astype(np.int64)}))
+    if not parts:
+        return pd.DataFrame({'domain': [], 'article': [], 'views': []})
+    return pd.concat(parts, ignore_index=True)
+
+
+def get_partial_filepath(fp):
+    fname = os.path.basename(fp)
+    return os.path.join(path_partials, fname.split('-')[1], fname.replace('.gz', '.parquet'))
+
+
+def hour_partial(fp, reuse=False):
+    """Pre-aggregated data of an hourly dump file: read from its cached partial aggregate if `reuse`,
+    otherwise parsed with preaggregate_dump_file and cached"""
+    partial = get_partial_filepath(fp)
+    if reuse:
+        return pd.read_parquet(partial)
+
+    df = preaggregate_dump_file(fp)
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    tmp = partial + '.tmp'
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, partial)
+    return df
+
+
+def is_partial_valid(fp):
+    """True if the partial aggregate of the hourly file is cached and more recent than the file, or if the file was
+    deleted (e.g. once aggregated) and its partial aggregate is cached"""
+    partial = get_partial_filepath(fp)
+    if not os.path.exists(partial):
+        return False
+    return not os.path.exists(fp) or os.path.getmtime(partial) >= os.path.getmtime(fp)
+
+
+def file_stat(fp):
+    st = os.stat(fp)
+    return [st.st_size, st.st_mtime]
+
+
+def get_day_record_filepath(day, output_format):
+    return os.path.join(path_partials, day, f'hours_{output_format}.json')
+
+
+def load_day_record(day, output_format):
+    """Dict hourly file name -> [size, mtime] of the files aggregated in the output of the day, empty if unknown"""
+    fp = get_day_record_filepath(day, output_format)
+    if not os.path.exists(fp):
+        return {}
+    with open(fp, 'r') as f:
+        return json.load(f)
+
+
+def save_day_record(day, files_day, output_format):
+    fp = get_day_record_filepath(day, output_format)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    # Hourly files deleted since they were aggregated keep their previous record
+    previous = load_day_record(day, output_format)
+    record = {
+        os.path.basename(fp_hour):
+            file_stat(fp_hour) if os.path.exists(fp_hour) else previous[os.path.basename(fp_hour)]
+        for fp_hour in files_day
+    }
+    with open(fp + '.tmp', 'w') as f:
+        json.dump(record, f)
+    os.replace(fp + '.tmp', fp)
+
 
 def aggregate_dump_files(filelist):
     """Load files in the list, group by domain and article and sum"""
@@ -70,42 +225,184 @@ def get_aggreg_filepath(day, path):
     return outfile
 
 
-def main():
-    files = os.listdir(path_data)
-    files = list(filter(lambda fname: fname.endswith('.gz'), files))
+def is_day_aggregated(day, output_format='csv'):
+    if output_format == 'parquet':
+        return dump_store.is_day_stored(day, keep_domains)
+    return os.path.exists(get_aggreg_filepath(day, path_aggreg))
 
-    unique_days = set(map(lambda fname: fname.split('-')[1], files))
 
-    for day in unique_days:
-        outfile = get_aggreg_filepath(day, path_aggreg)
-        if os.path.exists(outfile):
-            print('<WARNING> Skipping', day)
-            continue # don't re-process data that was already aggregated
+def get_pending_days(files, output_format='csv'):
+    """Dict day -> list of (path, reuse) of the dump files of the day, for the days that were not aggregated yet
+    or whose hourly files changed since. `reuse` is True if the cached partial aggregate of the file is up to date."""
+    # Gather files that correspond to the same day
+    days = {}
+    for fname in sorted(files):
+        days.setdefault(fname.split('-')[1], []).append(fname)
 
-        print('Processing day', day)
-
-        # Gather files that correspond to the same day
-        files_day = filter(lambda fname: day in fname, files)
+    pending = {}
+    for day, files_day in days.items():
         files_day = list(map(lambda fname: os.path.join(path_data, fname), files_day))
+        hours = {os.path.basename(fp): file_stat(fp) for fp in files_day}
+        record = load_day_record(day, output_format)
+
+        if is_day_aggregated(day, output_format):
+            changed = sorted(fname for fname in hours if record.get(fname) != hours[fname])
+            if len(record) == 0 or not changed:
+                # Days aggregated before partial aggregates were cached have no record
+                print('<WARNING> Skipping', day)
+                continue # don't re-process data that was already aggregated
+            # Hourly files deleted once aggregated are summed again from their cached partial aggregates
+            removed = [os.path.join(path_data, fname) for fname in sorted(set(record) - set(hours))]
+            lost = [os.path.basename(fp) for fp in removed if not is_partial_valid(fp)]
+            if lost:
+                print(f'<ERROR> Cannot update day {day} with {changed}, files {lost} were removed and their partial '
+                      f'aggregates are not cached <ERROR>')
+                continue
+            print(f'<WARNING> Updating day {day}, new or modified files: {changed}')
+            files_day = sorted(files_day + removed)
+
         # Warn if not 24 files are present
         if len(files_day) != 24:
             print(f'<WARNING> only {len(files_day)} files for date {day} <WARNING>')
+        pending[day] = [(fp, is_partial_valid(fp)) for fp in files_day]
+
+    return pending
+
+
+def sum_day(parts):
+    """Sum the pre-aggregated hourly data of a day by domain and article. Articles are mapped to the persistent
+    integer ids of dump_store and summed on the ids. Return a DataFrame with columns domain, article_id, views."""
+    df = pd.concat(parts, ignore_index=True)
+    sums = []
+    for domain, sub in df.groupby('domain', sort=True):
+        ids = dump_store.get_article_ids(domain).encode(sub.article)
+        unique_ids, views = dump_store.sum_by_id(ids, sub.views.values)
+        sums.append(pd.DataFrame({'domain': domain, 'article_id': unique_ids, 'views': views}))
+    if not sums:
+        return pd.DataFrame({'domain': [], 'article_id': [], 'views': []})
+    return pd.concat(sums, ignore_index=True)
+
+
+def record_day(day, files_day, output_format, catalog, seconds):
+    if files_day is None:
+        return
+    save_day_record(day, files_day, output_format)
+    if catalog is not None:
+        catalog.day_aggregated(day, output_format, [os.path.basename(fp) for fp in files_day], seconds)
+
+
+def save_day(day, parts, output_format='csv', files_day=None, catalog=None):
+    """Sum the pre-aggregated hourly data of a day and save it in `output_format`,
+    then record the hourly files `files_day` as aggregated (and in the catalog.Catalog if given)"""
+    start = time()
+    df = sum_day(parts)
+
+    if output_format == 'parquet':
+        dump_store.write_day(df, day, keep_domains)
+        print(f'Saved day {day} in {dump_store.path_store} in {time()-start:.4} s')
+        record_day(day, files_day, output_format, catalog, time() - start)
+        return
+
+    # The .csv files have article names
+    df = dump_store.add_article_names(df).drop(columns='article_id')
+
+    # Add column date
+    df['date'] = day
+
+    outfile = get_aggreg_filepath(day, path_aggreg)
+    df.to_csv(outfile,
+              index=False,
+              compression='gzip')
+    print(f'Saved {outfile} in {time()-start:.4} s')
+    record_day(day, files_day, output_format, catalog, time() - start)
+
+
+def aggregate_days_serial(pending, output_format='csv', catalog=None):
+    """Aggregate one day after the other, reading the files of a day with threads"""
+    for day, files_day in pending.items():
+        print('Processing day', day)
 
         # Load all files for the day
         start = time()
-        df = aggregate_dump_files(files_day)
+        with ThreadPoolExecutor(4) as executor:
+            parts = list(executor.map(lambda e: hour_partial(*e), files_day))
         print(f'Loaded and processed data of day {day} in {time()-start:.4} s')
 
-        # Add column date
-        df['date'] = day
+        save_day(day, parts, output_format, [fp for fp, _ in files_day], catalog)
+        del parts
 
-        # Save in gzip-compressed .csv format
-        start = time()
-        df.to_csv(outfile,
-                  index=False,
-                  compression='gzip')
-        del df
-        print(f'Saved {outfile} in {time()-start:.4} s')
+
+def aggregate_days_parallel(pending, processes=None, max_days=4, output_format='csv', catalog=None):
+    """
+    Parse and pre-aggregate the hourly files (or read their cached partial aggregates) in a pool of `processes`
+    worker processes, several days at once.
+    At most `max_days` days are in progress at the same time (their hourly data is held in memory until the day is
+    complete), the last day being summed and saved in a thread while the workers go on with the next days.
+    """
+    days = iter(pending.items())
+    parts = {}       # day -> pre-aggregated hourly DataFrames
+    remaining = {}   # day -> number of hourly files not parsed yet
+    futures = {}     # future -> day, for parsing and saving tasks
+    started = {}     # day -> time its processing started
+    paths = {}       # day -> paths of its hourly files
+
+    with ProcessPoolExecutor(processes) as pool, ThreadPoolExecutor(max_days) as savers:
+        def start_days():
+            while len(parts) < max_days:
+                day, files_day = next(days, (None, None))
+                if day is None:
+                    return
+                print('Processing day', day)
+                parts[day], remaining[day], started[day] = [], len(files_day), time()
+                paths[day] = [fp for fp, _ in files_day]
+                for fp, reuse in files_day:
+                    futures[pool.submit(hour_partial, fp, reuse)] = day
+
+        start_days()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                day = futures.pop(future)
+                result = future.result()
+                if day not in remaining:
+                    # Saving task of a complete day
+                    del parts[day]
+                    continue
+                parts[day].append(result)
+                remaining[day] -= 1
+                if remaining[day] == 0:
+                    del remaining[day]
+                    print(f'Loaded and processed data of day {day} in {time()-started.pop(day):.4} s')
+                    futures[savers.submit(save_day, day, parts[day], output_format, paths.pop(day), catalog)] = day
+            start_days()
+
+
+def main():
+    global parser
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                            help='number of worker processes parsing dump files, 0 to process days one after '
+                                 'the other with threads, default: number of CPUs')
+    arg_parser.add_argument('--max-days', type=int, default=4,
+                            help='maximum number of days in progress at the same time, bounds memory')
+    arg_parser.add_argument('--format', choices=output_formats, default='csv',
+                            help='csv: one .csv.gz file per day, parquet: columnar store partitioned by domain and day')
+    arg_parser.add_argument('--parser', choices=parsers, default=parser,
+                            help='arrow: multithreaded and robust to malformed lines, pandas: former parser, '
+                                 f'default: {parser}')
+    args = arg_parser.parse_args()
+    # Inherited by the worker processes, forked afterwards
+    parser = args.parser
+
+    # Complete files, those deleted since they were aggregated are left out
+    catalog = open_catalog()
+    files = catalog.files_present(path_data, ['downloaded', 'verified', 'aggregated'])
+    pending = get_pending_days(files, args.format)
+
+    if args.processes == 0:
+        aggregate_days_serial(pending, args.format, catalog)
+    else:
+        aggregate_days_parallel(pending, args.processes, args.max_days, args.format, catalog)
 
 
 if __name__ == '__main__':
@@ -135,13 +432,17 @@ def process_aggreg_file(fp, kwd_lst):
     return extract_kwds(df, kwd_lst)
 
 
-def extract_keywords(keyword_lst):
+def extract_keywords(keyword_lst, output_format='csv'):
     """Not intended to be used in a script, but call this function in an interpreter.
     You should manually test file integrity before running this, if you don't wanna loose faith in life :)
         $ gunzip -t <file>.gz
     Or even better, check all at once:
         $ for f in *; do echo $f; gunzip -t $f; done
+    With output_format='parquet', the articles are read from the columnar store, looking up their row groups in
+    the article index (see dump_store.py), such that only a few rows of each day are read.
     """
+    if output_format == 'parquet':
+        return dump_store.read_articles(keyword_lst, keep_domains).drop(columns='article_id')
 
     aggreg_files = os.listdir(path_aggreg)
     aggreg_files = [os.path.join(path_aggreg, fname) for fname in aggreg_files]
@@ -0,0 +1,113 @@
+"""
+Benchmark of the parsers of the hourly dump files: dump_parser.py (Arrow) against read_dump_file (pandas.read_csv).
+
+Every parser reads every file in a new process, which reports the parsing time, the number of rows parsed and the
+peak resident memory (ru_maxrss) reached while parsing, above that of the process before parsing. Throughputs are
+given in lines of the dump per second, the lines of other domains being skipped by the domain filter. A parser that
+fails on a file (e.g. a malformed line) is reported as failed.
+
+Usage:
+    $ python3 src/bench_parser.py /media/maousi/Raw/ada-wiki/dumps/pagecounts-20150401-1*.gz --domains en,fr,de,es
+    $ python3 src/bench_parser.py /media/maousi/Raw/ada-wiki/dumps/pagecounts-20150401-12*.gz --domains all
+"""
+
+import gzip
+import argparse
+import resource
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from aggregate_dumps import keep_domains, read_dump_file, parse_dump
+
+
+parsers = {
+    'arrow': parse_dump,
+    'pandas': read_dump_file,
+}
+
+
+def count_lines(fp):
+    """Number of lines of a gzip-compressed dump file"""
+    n = 0
+    with gzip.open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**24), b''):
+            n += chunk.count(b'\n')
+    return n
+
+
+def max_rss():
+    """Peak resident memory of the process, in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_parser(name, fp, domains):
+    """Parse a file in the current process, return (seconds, rows, peak memory in bytes) or the error"""
+    before = max_rss()
+    t = perf_counter()
+    try:
+        df = parsers[name](fp, domains)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return perf_counter() - t, len(df), max_rss() - before
+
+
+def bench(name, fp, domains, lines):
+    # A new process per run, such that the peak memory of a run does not hide that of the next one
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        result = executor.submit(run_parser, name, fp, domains).result()
+    if isinstance(result, str):
+        print(f'{name} failed on {fp}: {result}')
+        return {'parser': name, 'failed': 1, 'seconds': 0., 'lines': 0, 'rows': 0, 'peak MB': 0.}
+    seconds, rows, peak = result
+    print(f'{name}, {fp}: {rows} rows in {seconds:.2f} s, {lines / seconds:.0f} lines/s, peak {peak / 2**20:.0f} MB')
+    return {'parser': name, 'failed': 0, 'seconds': seconds, 'lines': lines, 'rows': rows, 'peak MB': peak / 2**20}
+
+
+def summarize(runs):
+    rows = []
+    for name in parsers:
+        runs_parser = [r for r in runs if r['parser'] == name]
+        if not runs_parser:
+            continue
+        seconds = sum(r['seconds'] for r in runs_parser)
+        lines = sum(r['lines'] for r in runs_parser)
+        rows.append({
+            'parser': name,
+            'files': len(runs_parser),
+            'failed': sum(r['failed'] for r in runs_parser),
+            'seconds': seconds,
+            'lines/s': lines / seconds if seconds > 0 else float('nan'),
+            'rows/s': sum(r['rows'] for r in runs_parser) / seconds if seconds > 0 else float('nan'),
+            'peak MB': max(r['peak MB'] for r in runs_parser),
+        })
+    return rows
+
+
+def print_table(rows):
+    columns = list(rows[0].keys())
+    print(' '.join(f'{c:>11}' for c in columns))
+    for row in rows:
+        print(' '.join(f'{v:>11.1f}' if isinstance(v, float) else f'{v:>11}' for v in row.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help='hourly dump files, pagecounts-*.gz')
+    parser.add_argument('--domains', default=','.join(keep_domains),
+                        help='comma-separated domains to keep, or "all" to parse every line')
+    parser.add_argument('--parsers', default=','.join(parsers), help=f'comma-separated among {", ".join(parsers)}')
+    args = parser.parse_args()
+    domains = None if args.domains == 'all' else args.domains.split(',')
+
+    runs = []
+    for fp in args.files:
+        lines = count_lines(fp)
+        for name in args.parsers.split(','):
+            runs.append(bench(name, fp, domains, lines))
+
+    print()
+    print_table(summarize(runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+End-to-end benchmark of the aggregation of the hourly dumps, on synthetic dumps (see synth_dumps.py).
+
+The dumps are generated once in `--data` (existing files are reused), then each stage runs in a new process, with
+the paths of download_dumps, aggregate_dumps and dump_store pointing to a scratch directory:
+
+    dump_files       aggregate_dump_files of the files of the first day
+    main_csv         aggregate_dumps.main --format csv, parsing every file
+    main_parquet     aggregate_dumps.main --format parquet, parsing every file
+    rerun_parquet    aggregate_dumps.main --format parquet again: nothing to do
+    update_parquet   aggregate_dumps.main --format parquet after an hourly file was modified: its day is summed again
+    extract_csv      extract_keywords of `--keywords` articles, output_format='csv'
+    extract_parquet  extract_keywords of `--keywords` articles, output_format='parquet'
+
+and reports its time, its throughput in dump lines per second (rows returned per second for extract_keywords),
+and the peak resident memory (ru_maxrss) of the stage process and of its largest worker process.
+
+Usage:
+    $ python3 src/bench_pipeline.py --data /tmp/synth-dumps --days 2 --lines 1000000 --processes 4
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import resource
+import multiprocessing
+from time import perf_counter
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import download_dumps
+import aggregate_dumps
+import dump_store
+from synth_dumps import DumpGenerator, generate_dumps, get_articles
+from bench_parser import count_lines as count_file_lines
+
+
+stages = ['dump_files', 'main_csv', 'main_parquet', 'rerun_parquet', 'update_parquet', 'extract_csv',
+          'extract_parquet']
+
+
+def configure(data, work):
+    """Point the modules of the pipeline to the dumps of `data` and to the scratch directory `work`"""
+    download_dumps.path_data = data
+    download_dumps.catalog_path = os.path.join(work, 'catalog.sqlite')
+    download_dumps.manifest_path = os.path.join(work, 'manifest.json')
+    aggregate_dumps.path_data = data
+    aggregate_dumps.path_aggreg = os.path.join(work, 'aggreg')
+    aggregate_dumps.path_partials = os.path.join(work, 'partials')
+    dump_store.path_store = os.path.join(work, 'store')
+    os.makedirs(aggregate_dumps.path_aggreg, exist_ok=True)
+    # The worker processes of aggregate_dumps must inherit these paths, a spawned process would import the defaults
+    multiprocessing.set_start_method('fork', force=True)
+
+
+def max_rss():
+    """Peak resident memory of the process and of its largest child process, in bytes"""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def dump_files(data):
+    return sorted(fname for fname in os.listdir(data) if fname.startswith('pagecounts-') and fname.endswith('.gz'))
+
+
+def run_main(output_format, processes):
+    sys.argv = ['aggregate_dumps.py', '--processes', str(processes), '--format', output_format]
+    aggregate_dumps.main()
+
+
+def run_stage(stage, data, work, processes, keywords):
+    """Run a stage in the current process, return (seconds, number of rows, peak memory of the process and of the
+    workers in bytes)"""
+    configure(data, work)
+    files = dump_files(data)
+    rows = None
+
+    if stage.startswith('main'):
+        # Every file is parsed again
+        shutil.rmtree(aggregate_dumps.path_partials, ignore_errors=True)
+    elif stage == 'update_parquet':
+        # Modified since its day was aggregated
+        os.utime(os.path.join(data, files[0]))
+
+    t = perf_counter()
+    if stage == 'dump_files':
+        day = files[0].split('-')[1]
+        rows = len(aggregate_dumps.aggregate_dump_files(
+            [os.path.join(data, fname) for fname in files if fname.split('-')[1] == day]))
+    elif stage.startswith('extract'):
+        rows = len(aggregate_dumps.extract_keywords(keywords, stage.split('_')[1]))
+    else:
+        run_main(stage.split('_')[1], processes)
+    return (perf_counter() - t, rows, *max_rss())
+
+
+def bench(stage, data, work, processes, keywords, lines):
+    # A new process per stage, such that the peak memory of a stage does not hide that of the next one
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        seconds, rows, peak, peak_workers = executor.submit(
+            run_stage, stage, data, work, processes, keywords).result()
+
+    if stage == 'dump_files':
+        day = min(lines).split('-')[1]
+        lines = sum(n for fname, n in lines.items() if fname.split('-')[1] == day)
+    elif stage == 'update_parquet':
+        lines = lines[min(lines)]
+    elif stage == 'rerun_parquet':
+        lines = 0
+    else:
+        lines = sum(lines.values())
+    throughput = (rows if rows is not None and stage.startswith('extract') else lines) / seconds
+    print(f'{stage}: {seconds:.2f} s, {throughput:.0f} {"rows" if stage.startswith("extract") else "lines"}/s, '
+          f'peak {peak / 2**20:.0f} MB, workers {peak_workers / 2**20:.0f} MB')
+    return {
+        'stage': stage, 'seconds': seconds, 'per second': throughput,
+        'peak MB': peak / 2**20, 'workers MB': peak_workers / 2**20,
+    }
+
+
+def count_lines(data):
+    """Dict file name -> number of lines of the dumps of `data`"""
+    return {fname: count_file_lines(os.path.join(data, fname)) for fname in dump_files(data)}
+
+
+def print_table(rows):
+    columns = list(rows[0].keys())
+    print(' '.join(f'{c:>15}' for c in columns))
+    for row in rows:
+        print(' '.join(f'{v:>15.1f}' if isinstance(v, float) else f'{v:>15}' for v in row.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'synth-dumps'),
+                        help='directory of the synthetic dumps, generated if missing')
+    parser.add_argument('--work', default=None, help='scratch directory of the outputs, default: a new temporary one')
+    parser.add_argument('--start', default='20150401', help='first day, YYYYMMDD')
+    parser.add_argument('--days', type=int, default=2, help='number of days')
+    parser.add_argument('--hours', type=int, default=24, help='number of hours per day')
+    parser.add_argument('--lines', type=int, default=1000000, help='number of page requests per hour')
+    parser.add_argument('--articles', type=int, default=2000000, help='number of articles per domain')
+    parser.add_argument('--domains', type=int, default=50, help='number of domains')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='--processes of aggregate_dumps.main')
+    parser.add_argument('--keywords', type=int, default=500, help='number of articles of extract_keywords')
+    parser.add_argument('--stages', default=','.join(stages), help='comma-separated stages, see above')
+    args = parser.parse_args()
+
+    end = (datetime.strptime(args.start, '%Y%m%d') + timedelta(days=args.days - 1)).strftime('%Y%m%d')
+    generator = DumpGenerator(args.lines, args.articles, args.domains)
+    generate_dumps(args.data, args.start, end, generator, args.hours)
+    lines = count_lines(args.data)
+    print(f'{len(lines)} files, {sum(lines.values())} lines')
+
+    # Popular and rare articles, some of which have no views
+    articles = get_articles(args.articles)
+    keywords = [a.decode('utf-8') for a in articles[:args.keywords // 2] + articles[-(args.keywords // 2):]]
+
+    work = args.work or tempfile.mkdtemp(prefix='bench-pipeline-')
+    rows = []
+    try:
+        for stage in args.stages.split(','):
+            rows.append(bench(stage, args.data, work, args.processes, keywords, lines))
+    finally:
+        if args.work is None:
+            shutil.rmtree(work)
+
+    print()
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
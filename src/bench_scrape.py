@@ -0,0 +1,173 @@
+"""
+Throughput benchmark of the scraping code against the local stand-in server of `fake_pageviews_api.py`.
+
+Drives PageviewsClient (pooled threads), AsyncPageviewsClient (asyncio) and the former transport (a new thread
+pool and a new connection for every request) at several `parallelism` values, and reports requests per second,
+p50/p99 latency of single requests (including retries), p99 queue wait (see request_metrics.py) and peak memory
+allocated by Python (tracemalloc) while fetching. Run it before and after changing the scraping code to catch
+throughput regressions. Tracing memory slows Python down, compare throughputs measured with the same
+`--no-memory` setting only.
+
+The server answers from `--server-processes` processes, with a mean latency of `--latency` (50 ms by default, about
+that of the real API). Without latency, every client saturates the server at any parallelism: such a run measures the
+server, not the client.
+
+Usage:
+    $ python3 src/bench_scrape.py --articles 2000 --parallelism 5,10,20,50 --latency 0.05 --throttle-rate 0.01
+"""
+
+import os
+import argparse
+import asyncio
+import threading
+import tracemalloc
+import numpy as np
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from scrape_wiki import PageviewsClient
+from scrape_wiki_async import AsyncPageviewsClient
+from request_metrics import RequestMetrics
+import fake_pageviews_api
+
+
+project = 'de.wikipedia'
+start, end = '20180101', '20181231'
+
+
+class UnpooledClient(PageviewsClient):
+    """Transport used before connection pooling, kept as a reference"""
+    def get_json(self, url):
+        t = perf_counter()
+        r = requests.get(url, headers=self.headers, timeout=self.timeout)
+        self.metrics.record('article', url, r.status_code, perf_counter() - t, n_bytes=len(r.content))
+        return r.json()
+
+    def get_concurrent(self, urls, partial=False):
+        with ThreadPoolExecutor(self.parallelism) as executor:
+            return list(executor.map(self.get_json, urls))
+
+
+def batches(articles, size):
+    for i in range(0, len(articles), size):
+        yield articles[i:i + size]
+
+
+def run_sync(client, articles, batch):
+    failed = []
+    for b in batches(articles, batch):
+        if isinstance(client, UnpooledClient):
+            client.article_views(project, b, start=start, end=end, output_format='frame')
+        else:
+            failed.extend(client.article_views(
+                project, b, start=start, end=end, output_format='frame', partial=True)[1])
+    return failed
+
+
+def run_async(client, articles, batch):
+    async def run():
+        failed = []
+        async with client:
+            for b in batches(articles, batch):
+                output, failed_batch = await client.article_views(
+                    project, b, start=start, end=end, output_format='frame', partial=True)
+                failed.extend(failed_batch)
+        return failed
+
+    return asyncio.run(run())
+
+
+def bench(kind, api_root, articles, batch, parallelism, max_rate, memory=True):
+    """Fetch `articles`, return a dict of measures"""
+    # Exact latencies of every request, the histograms of RequestMetrics are approximate
+    latencies, queue_waits = [], []
+    lock = threading.Lock()
+
+    def collect(event):
+        with lock:
+            latencies.append(event['latency'])
+            queue_waits.append(event['queue_wait'])
+
+    kwargs = dict(parallelism=parallelism, api_root=api_root, max_rate=max_rate,
+                  metrics=RequestMetrics(callbacks=[collect]))
+    if kind == 'async':
+        client = AsyncPageviewsClient('benchmark', **kwargs)
+    elif kind == 'unpooled':
+        client = UnpooledClient('benchmark', **kwargs)
+    else:
+        client = PageviewsClient('benchmark', **kwargs)
+
+    if memory:
+        tracemalloc.start()
+    t = time()
+    if kind == 'async':
+        failed = run_async(client, articles, batch)
+    else:
+        with client:
+            failed = run_sync(client, articles, batch)
+    duration = time() - t
+    peak = np.nan
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'client': kind,
+        'parallelism': parallelism,
+        'requests': len(latencies),
+        'failed': len(failed),
+        'seconds': duration,
+        'req/s': len(latencies) / duration,
+        'p50 ms': np.percentile(latencies, 50),
+        'p99 ms': np.percentile(latencies, 99),
+        'wait p99 ms': np.percentile(queue_waits, 99) * 1000,
+        'peak MB': peak / 2**20,
+    }
+
+
+def print_table(rows):
+    columns = list(rows[0].keys())
+    print(' '.join(f'{c:>11}' for c in columns))
+    for row in rows:
+        print(' '.join(f'{v:>11.1f}' if isinstance(v, float) else f'{v:>11}' for v in row.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--articles', type=int, default=2000, help='number of articles to fetch')
+    parser.add_argument('--batch', type=int, default=500, help='number of articles per article_views call')
+    parser.add_argument('--parallelism', default='5,10,20,50',
+                        help='comma-separated parallelism values (threads, or requests in flight for async)')
+    parser.add_argument('--clients', default='pooled,async', help='comma-separated among pooled, async, unpooled')
+    parser.add_argument('--max-rate', type=float, default=None, help='client rate limit (req/s), default: none')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of the server, in seconds')
+    parser.add_argument('--server-processes', type=int, default=max(1, os.cpu_count() // 2),
+                        help='number of processes of the server, default: half the CPUs')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with HTTP 503')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests throttled (HTTP 429)')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory allocations')
+    args = parser.parse_args()
+
+    servers, api_root = fake_pageviews_api.serve_processes(
+        args.server_processes, latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        retry_after=0)
+    articles = [f'Article_{i}' for i in range(args.articles)]
+
+    rows = []
+    try:
+        for kind in args.clients.split(','):
+            for parallelism in map(int, args.parallelism.split(',')):
+                rows.append(bench(
+                    kind, api_root, articles, args.batch, parallelism, args.max_rate, memory=not args.no_memory))
+                print(f'{kind}, parallelism {parallelism}: {rows[-1]["req/s"]:.1f} req/s')
+    finally:
+        for server in servers:
+            server.terminate()
+
+    print()
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
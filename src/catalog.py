@@ -0,0 +1,210 @@
+"""
+SQLite catalog of the hourly dump files and of their processing, shared by download_dumps.py, check_hashes.py,
+aggregate_dumps.py and pipeline.py, such that they query the state of the files instead of listing `path_data`.
+It is stored next to the dumps (`download_dumps.catalog_path`).
+
+Table `dumps` has one row per hourly file, with its status:
+    pending     to be downloaded (or downloaded again, e.g. when its checksum does not match)
+    downloaded  complete file in `path_data`, checksum not verified
+    verified    checksum matches the published one
+    aggregated  summed in the output of its day
+    removed     deleted from `path_data` after it was downloaded, e.g. to free space once aggregated
+along with its size, modification time, MD5 checksum and the time spent downloading and hashing it. A checksum is
+only trusted while the size and modification time of the file are unchanged (see md5), `verified` tells whether it
+matched the published one (NULL until compared), such that check_hashes.py and pipeline.py only hash new or modified
+files. Each update is a single transaction, the scripts can record checksums at the same time.
+Table `days` records when each day was aggregated, per output format, from how many files and in how long.
+"""
+
+import os
+import sqlite3
+import threading
+from time import time
+
+
+statuses = ['pending', 'downloaded', 'verified', 'aggregated', 'removed']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS dumps (
+    fname TEXT PRIMARY KEY,
+    day TEXT NOT NULL,
+    url TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    size INTEGER,
+    mtime REAL,
+    md5 TEXT,
+    verified INTEGER,
+    download_seconds REAL,
+    verify_seconds REAL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS dumps_day ON dumps (day);
+CREATE INDEX IF NOT EXISTS dumps_status ON dumps (status);
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT NOT NULL,
+    output_format TEXT NOT NULL,
+    n_files INTEGER,
+    seconds REAL,
+    updated REAL,
+    PRIMARY KEY (day, output_format)
+);
+'''
+
+
+class Catalog:
+    def __init__(self, path):
+        """
+        :param str path: SQLite file of the catalog, created if needed
+        """
+        self.path = path
+        self.created = not os.path.exists(path)
+        # Shared by the threads of the scripts, queries are serialized by the lock
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        # Several scripts may use the catalog at the same time
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(schema)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(dumps)')]
+        if 'verified' not in columns:
+            # Catalogs created before checksums moved from manifest.json to the catalog
+            self.connection.execute('ALTER TABLE dumps ADD COLUMN verified INTEGER')
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.connection.close()
+
+    def execute(self, query, params=()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def add(self, links):
+        """Add the (file name, url) of `links` as pending, unless already in the catalog (then only fill in a missing
+        url, e.g. of files from import_directory)"""
+        rows = [(fname, fname.split('-')[1], url, time()) for fname, url in links]
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT INTO dumps (fname, day, url, updated) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (fname) DO UPDATE SET url = excluded.url WHERE url IS NULL', rows)
+            self.connection.execute('COMMIT')
+
+    def update(self, fname, fp=None, **fields):
+        """Update the given columns of a file. If the path `fp` of the file is given, its size and mtime are recorded
+        too: its md5 must then be given if the file changed since it was recorded."""
+        if fp is not None and os.path.exists(fp):
+            st = os.stat(fp)
+            fields.update(size=st.st_size, mtime=st.st_mtime)
+        fields.update(updated=time())
+        columns = ', '.join(f'{c} = ?' for c in fields)
+        self.execute(f'UPDATE dumps SET {columns} WHERE fname = ?', (*fields.values(), fname))
+
+    def set_status(self, fname, status, fp=None, **fields):
+        """Update the status of a file, and the given columns (md5, verified, download_seconds, verify_seconds),
+        see update"""
+        if status not in statuses:
+            raise ValueError(f'Unknown status {status}, must be one of {statuses}')
+        self.update(fname, fp, status=status, **fields)
+
+    def record_md5(self, fname, fp, md5, **fields):
+        """Record the checksum of the file at `fp`, not compared to the published one yet"""
+        self.update(fname, fp, md5=md5, verified=None, **fields)
+
+    def set_verified(self, fname, verified):
+        """Record whether the checksum of the file matched the published one"""
+        self.update(fname, verified=int(verified))
+
+    def md5(self, fname, fp):
+        """Recorded checksum of the file at `fp`, None if unknown or if the file changed since it was recorded"""
+        row = self.get(fname)
+        st = os.stat(fp)
+        if row is None or row['md5'] is None or row['size'] != st.st_size or row['mtime'] != st.st_mtime:
+            return None
+        return row['md5']
+
+    def is_verified(self, fname, fp):
+        """True if the recorded checksum of the file is up to date and matched the published one"""
+        return self.md5(fname, fp) is not None and self.get(fname)['verified'] == 1
+
+    def get(self, fname):
+        """Row of the file as a dict, None if not in the catalog"""
+        with self.lock:
+            cursor = self.connection.execute('SELECT * FROM dumps WHERE fname = ?', (fname,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def files(self, status=None, start=None, end=None):
+        """Sorted names of the files with the given status (a status or a list of statuses, default: all),
+        of the days `start` to `end` (YYYYMMDD, included)"""
+        query, params = 'SELECT fname FROM dumps WHERE 1', []
+        if status is not None:
+            status = [status] if isinstance(status, str) else list(status)
+            query += f' AND status IN ({", ".join("?" * len(status))})'
+            params += status
+        if start is not None:
+            query += ' AND day >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND day <= ?'
+            params.append(end)
+        return [fname for fname, in self.execute(query + ' ORDER BY fname', params)]
+
+    def files_present(self, path_data, status=None, start=None, end=None):
+        """Names of the files (see files) that are still in `path_data`. Missing aggregated files are marked as
+        removed, the other missing files as pending, such that they are downloaded again."""
+        present = []
+        for fname in self.files(status, start, end):
+            if os.path.exists(os.path.join(path_data, fname)):
+                present.append(fname)
+            elif self.get(fname)['status'] == 'aggregated':
+                self.set_status(fname, 'removed')
+            else:
+                self.set_status(fname, 'pending')
+        return present
+
+    def files_by_day(self, status=None, start=None, end=None):
+        """Dict day -> sorted names of its files, see files"""
+        days = {}
+        for fname in self.files(status, start, end):
+            days.setdefault(fname.split('-')[1], []).append(fname)
+        return days
+
+    def day_aggregated(self, day, output_format, fnames, seconds):
+        """Record the aggregation of a day from the files `fnames`"""
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.execute(
+                'INSERT OR REPLACE INTO days (day, output_format, n_files, seconds, updated) VALUES (?, ?, ?, ?, ?)',
+                (day, output_format, len(fnames), seconds, time()))
+            self.connection.executemany(
+                "UPDATE dumps SET status = 'aggregated', updated = ? WHERE fname = ? AND status != 'removed'",
+                [(time(), fname) for fname in fnames])
+            self.connection.execute('COMMIT')
+
+    def summary(self):
+        """Dict status -> (number of files, total size in bytes)"""
+        return {
+            status: (n, size or 0)
+            for status, n, size in self.execute('SELECT status, COUNT(*), SUM(size) FROM dumps GROUP BY status')
+        }
+
+    def import_directory(self, path_data, checksums=None):
+        """Add the dump files already in `path_data` (e.g. downloaded before the catalog existed) as downloaded,
+        or verified if their checksum in `checksums` is up to date and matched.
+        :param dict checksums: file name -> {'size', 'mtime', 'md5', 'verified'}, e.g. of the former manifest.json
+        """
+        checksums = checksums or {}
+        for fname in os.listdir(path_data):
+            if not fname.endswith('.gz'):
+                continue
+            fp = os.path.join(path_data, fname)
+            self.add([(fname, None)])
+            self.set_status(fname, 'downloaded', fp)
+            entry = checksums.get(fname)
+            st = os.stat(fp)
+            if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                self.record_md5(fname, fp, entry['md5'])
+                if entry['verified'] is not None:
+                    self.set_verified(fname, entry['verified'])
+                if entry['verified'] is True:
+                    self.set_status(fname, 'verified')
@@ -1,11 +1,11 @@
 
 
 import os
-from download_dumps import path_data, base_url, get_url_suffix, download_file
+from download_dumps import path_data, base_url, get_url_suffix, download_file, file_md5, open_catalog
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import requests
 from time import sleep
-import hashlib
 import argparse
 
 
@@ -32,71 +32,116 @@ def get_checksum_files(files):
     return checksum_files
 
 
+def get_checksum_file(suffix, url, session=None, refresh=False):
+    """Path of the local copy of the md5sums.txt file of a month (`suffix` from get_url_suffix), downloaded if needed,
+    or again if `refresh` (e.g. the local copy predates some files of the month)"""
+    output_path = 'checksums-' + suffix.split('/')[1] + '.txt'
+    output_path = os.path.join(path_data, output_path)
+    if refresh or not os.path.exists(output_path):
+        # The local copy is only replaced once the new one is complete
+        new_path = output_path + '.new'
+        for fp in (new_path, new_path + '.part'):
+            if os.path.exists(fp):
+                os.remove(fp)
+        statuscode = download_file(url, new_path, session)
+        if os.path.exists(new_path):
+            os.replace(new_path, output_path)
+        print(f'Downloaded {output_path}, {statuscode}')
+    return output_path
+
+
+def read_checksum_file(fp):
+    """Dict file name -> md5 checksum of a md5sums.txt file"""
+    with open(fp, 'r') as file:
+        lines = file.read().strip('\n').split('\n')
+    return {e[1]: e[0] for e in map(parse_md5sum_output, lines)}
+
+
 def compute_file_md5sum(fp):
     if fp.endswith('.txt'):
         return None
 
     print(f'Computing checksum of {fp}')
-    with open(fp, 'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
+    return file_md5(fp).hexdigest()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('date', help='check files that have the given substring in their name',
                         default=None, nargs='?')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of files hashed in parallel, default: number of CPUs')
+    parser.add_argument('--rehash', action='store_true',
+                        help='hash every file again, even those unchanged since their checksum was recorded')
     args = parser.parse_args()
     subset = args.date
 
-    files = os.listdir(path_data)
+    catalog = open_catalog()
+    # Files deleted since they were aggregated are left out
+    files = catalog.files_present(path_data, ['downloaded', 'verified', 'aggregated'])
 
     print('Determining required checksum files...')
     checksum_files = get_checksum_files(files)
     checksum_files_url = list(checksum_files.values())
     checksum_files_datesuffix = list(checksum_files.keys())
 
-    ckecksum_file_paths = []
-    for suffix, url in checksum_files.items():
-        output_path = 'checksums-' + suffix.split('/')[1] + '.txt'
-        output_path = os.path.join(path_data, output_path)
-        ckecksum_file_paths.append(output_path)
-        if os.path.exists(output_path):
-            continue
-
-        statuscode = download_file(url, output_path)
-        print(f'Downloaded {output_path}, {statuscode}')
+    ckecksum_file_paths = [get_checksum_file(suffix, url) for suffix, url in checksum_files.items()]
 
     print('Aggregating checksum files...')
-    checksum_data = []
+    checksum_data = {}
     for f in ckecksum_file_paths:
-        with open(f, 'r') as file:
-            checksum_data.extend(file.read().strip('\n').split('\n'))
-
-    checksum_data = list(map(parse_md5sum_output, checksum_data))
-    checksum_data = {e[1]: e[0] for e in checksum_data}
+        checksum_data.update(read_checksum_file(f))
 
-    # Remove fext files
-    files = list(filter(lambda fname: '.txt' not in fname, files))
+    # Remove text files and partial downloads (.part)
+    files = list(filter(lambda fname: fname.endswith('.gz'), files))
 
     # Select only files the user wants to check
     if subset is not None:
         files = list(filter(lambda fname: subset in fname, files))
 
     # Get full files path
-    files_path = map(lambda fname: os.path.join(path_data, fname), files)
-    #files_path = list(files_path)[:10]
+    files_path = list(map(lambda fname: os.path.join(path_data, fname), files))
+
+    # Compute checksums of the files that are new or modified since the last run
+    pending = [
+        (fname, fp) for fname, fp in zip(files, files_path) if args.rehash or catalog.md5(fname, fp) is None
+    ]
+    print(f'{len(files_path) - len(pending)} checksums read from the catalog, {len(pending)} files to hash')
+    with ProcessPoolExecutor(args.processes) as executor:
+        for (fname, fp), md5 in zip(pending, executor.map(compute_file_md5sum, [fp for _, fp in pending])):
+            catalog.record_md5(fname, fp, md5)
 
-    # Compute checksums
-    local_checksums = map(compute_file_md5sum, files_path)
     # Create dict of local checksums
-    local_checksums = dict(zip(files, local_checksums))
+    local_checksums = {fname: catalog.md5(fname, fp) for fname, fp in zip(files, files_path)}
+
+    # Files without a published checksum can not be checked, they are neither verified nor removed
+    unknown = [fname for fname in files if fname not in checksum_data]
+    if unknown:
+        # Unless the local copies of the md5sums.txt files are out of date
+        for suffix, url in get_checksum_files(unknown).items():
+            checksum_data.update(read_checksum_file(get_checksum_file(suffix, url, refresh=True)))
+        unknown = [fname for fname in files if fname not in checksum_data]
+    if unknown:
+        print(f'<WARNING> no published checksum of {len(unknown)} files: {unknown}')
+        files = [fname for fname in files if fname in checksum_data]
 
     # Check local checksums against those on checksums.txt files
     validate = lambda fname: local_checksums[fname] == checksum_data.get(fname, None)
-    corresp = list(map(validate, local_checksums))
+    corresp = list(map(validate, files))
 
     bad_checksum = dict(filter(lambda e: not e[1], zip(files, corresp)))
 
+    for fname, ok in zip(files, corresp):
+        catalog.set_verified(fname, ok)
+        status = catalog.get(fname)['status']
+        if not ok:
+            # Downloaded again by the next run of download_dumps.py, like in pipeline.Pipeline.verify
+            print(f'<WARNING> bad checksum of {fname}, removed')
+            os.remove(os.path.join(path_data, fname))
+            catalog.set_status(fname, 'pending')
+        elif status != 'aggregated':
+            catalog.set_status(fname, 'verified')
+
     print('\nList of bad checksum:')
     print('\n'.join(bad_checksum))
 
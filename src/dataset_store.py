@@ -0,0 +1,227 @@
+"""
+Store of the pageview datasets of the keyword lists (e.g. GDPR in German), written incrementally by
+update_keywords.request instead of regenerating long-format CSV files like `data/GDPR_de.csv` in full.
+
+Each (list, language, granularity) is a partition of append-only Parquet parts, with one row per (article, date) that
+has views. Days without data are not stored: the ranges of days fetched for each article are recorded instead, in
+`_fetched.json`, such that they can be told apart from days that were never fetched.
+
+    {path_datasets}/list=GDPR/language=de/granularity=daily/
+        part-001607712345123-0012345-000000.parquet    (article, date, views), see part_name
+        _fetched.json                                  {article: [[start, end]]}
+
+upsert only appends the rows that are new or whose views changed, the latest part wins when a row is in several
+parts. compact merges the parts of a partition into one, remove_articles drops the series of articles.
+
+Usage:
+    >>> request(keywords, 'de', 'GDPR')         # calls upsert(frame, 'GDPR', 'de', start, end)
+    >>> df = load('GDPR', 'de')                 # article, date, views, language, NaN where no data
+    >>> df = load('GDPR', 'de', shape='wide')   # dates x articles
+"""
+
+import os
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from time import time
+from scrape_wiki import output_index
+from pageviews_cache import merge_ranges
+
+
+path_datasets = 'data/datasets'
+
+schema = pa.schema([('article', pa.string()), ('date', pa.timestamp('s')), ('views', pa.float64())])
+
+shapes = ['long', 'wide']
+
+# Parts written by the process, such that two parts written in the same millisecond get different names
+part_counter = itertools.count()
+
+
+def partition_path(listname, language, granularity='daily', path=None):
+    return os.path.join(path or path_datasets, f'list={listname}', f'language={language}',
+                        f'granularity={granularity}')
+
+
+def fetched_path(listname, language, granularity='daily', path=None):
+    return os.path.join(partition_path(listname, language, granularity, path), '_fetched.json')
+
+
+def part_name():
+    """Name of a new part: its creation time in ms, then the process and a counter of the parts of the process"""
+    return f'part-{int(time() * 1000):015}-{os.getpid():07}-{next(part_counter):06}.parquet'
+
+
+def part_files(listname, language, granularity='daily', path=None):
+    """Parts of a partition, oldest first"""
+    directory = partition_path(listname, language, granularity, path)
+    if not os.path.exists(directory):
+        return []
+    parts = [f for f in os.listdir(directory) if f.startswith('part-') and f.endswith('.parquet')]
+    # Parts are named after their creation time, padded to the same length, see part_name
+    return [os.path.join(directory, f) for f in sorted(parts)]
+
+
+def load_fetched(listname, language, granularity='daily', path=None):
+    """Dict article -> fetched ranges of days [['YYYYMMDD', 'YYYYMMDD'], ...]"""
+    fp = fetched_path(listname, language, granularity, path)
+    if not os.path.exists(fp):
+        return {}
+    with open(fp, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_fetched(fetched, listname, language, granularity='daily', path=None):
+    fp = fetched_path(listname, language, granularity, path)
+    with open(fp + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(fetched, f, ensure_ascii=False)
+    os.replace(fp + '.tmp', fp)
+
+
+def read_rows(listname, language, granularity='daily', path=None):
+    """Rows (article, date, views) of a partition, the latest one of each (article, date)"""
+    # Parts written before views were float64 are cast
+    parts = [pq.read_table(fp).cast(schema) for fp in part_files(listname, language, granularity, path)]
+    if not parts:
+        return schema.empty_table().to_pandas()
+    df = pa.concat_tables(parts).to_pandas()
+    return df.drop_duplicates(['article', 'date'], keep='last').reset_index(drop=True)
+
+
+def to_rows(frame):
+    """Rows (article, date, views) of the non-missing views of a (dates x articles) frame, see request"""
+    df = frame.rename_axis(index='date', columns='article').stack().rename('views').reset_index()
+    df = df[['article', 'date', 'views']].dropna(subset=['views'])
+    df['article'] = df.article.astype(str)
+    df['date'] = pd.to_datetime(df.date).astype('datetime64[s]')
+    # Views above 2**24 are not exact in float32, see scrape_wiki.columnar_output
+    df['views'] = df.views.astype(np.float64)
+    return df.reset_index(drop=True)
+
+
+def upsert(frame, listname, language, start, end, granularity='daily', path=None):
+    """
+    Add the pageviews of a (dates x articles) frame, as returned by update_keywords.request, to a partition. Only
+    the rows that are new or whose views changed are written, in a new part.
+    :param str start: first day requested, YYYYMMDD
+    :param str end: last day requested, YYYYMMDD
+    :return: number of rows written
+    """
+    directory = partition_path(listname, language, granularity, path)
+    os.makedirs(directory, exist_ok=True)
+
+    rows = to_rows(frame)
+    existing = read_rows(listname, language, granularity, path)
+    merged = rows.merge(existing, on=['article', 'date'], how='left', suffixes=('', '_stored'))
+    new = rows[(merged.views != merged.views_stored).values]
+
+    if len(new) > 0:
+        fp = os.path.join(directory, part_name())
+        table = pa.Table.from_pandas(new, schema=schema, preserve_index=False)
+        pq.write_table(table, fp + '.tmp', compression='zstd')
+        os.replace(fp + '.tmp', fp)
+
+    # Recorded after the rows, an interrupted upsert is fetched again
+    fetched = load_fetched(listname, language, granularity, path)
+    for article in frame.columns.astype(str):
+        fetched[article] = merge_ranges(fetched.get(article, []) + [[start, end]])
+    save_fetched(fetched, listname, language, granularity, path)
+    return len(new)
+
+
+def rewrite(df, listname, language, granularity='daily', path=None):
+    """Replace the parts of a partition by a single part of the rows `df`"""
+    parts = part_files(listname, language, granularity, path)
+    directory = partition_path(listname, language, granularity, path)
+    fp = os.path.join(directory, part_name())
+    table = pa.Table.from_pandas(df.sort_values(['article', 'date']), schema=schema, preserve_index=False)
+    pq.write_table(table, fp + '.tmp', compression='zstd')
+    os.replace(fp + '.tmp', fp)
+    for old in parts:
+        os.remove(old)
+
+
+def compact(listname, language, granularity='daily', path=None):
+    """Merge the parts of a partition into one"""
+    if len(part_files(listname, language, granularity, path)) <= 1:
+        return
+    rewrite(read_rows(listname, language, granularity, path), listname, language, granularity, path)
+
+
+def missing_articles(articles, listname, language, start, end, granularity='daily', path=None):
+    """Articles of `articles` whose days `start` to `end` (YYYYMMDD) were not all fetched into the partition"""
+    fetched = load_fetched(listname, language, granularity, path)
+    return [
+        article for article in articles
+        if not any(first <= start and end <= last for first, last in fetched.get(article, []))
+    ]
+
+
+def remove_articles(articles, listname, language, granularity='daily', path=None):
+    """
+    Remove the rows and fetched ranges of `articles` from a partition, e.g. articles no longer in the list. The
+    partition is rewritten in a single part.
+    :return: number of rows removed
+    """
+    articles = set(map(str, articles))
+    fetched = load_fetched(listname, language, granularity, path)
+    df = read_rows(listname, language, granularity, path)
+    removed = df.article.isin(articles)
+    if removed.any():
+        rewrite(df[~removed], listname, language, granularity, path)
+    # Removed after the rows, such that an interrupted removal leaves no rows without fetched ranges
+    if articles & set(fetched):
+        save_fetched({a: r for a, r in fetched.items() if a not in articles}, listname, language, granularity, path)
+    return int(removed.sum())
+
+
+def fetched_grid(fetched, granularity='daily'):
+    """DataFrame (article, date) of every fetched day of each article"""
+    parts = [
+        pd.DataFrame({'article': article, 'date': output_index(granularity, pd.Timestamp(start), pd.Timestamp(end))})
+        for article, ranges in fetched.items() for start, end in ranges
+    ]
+    if not parts:
+        return pd.DataFrame({'article': pd.Series([], dtype=str), 'date': pd.Series([], dtype='datetime64[s]')})
+    grid = pd.concat(parts, ignore_index=True)
+    grid['date'] = grid.date.astype('datetime64[s]')
+    return grid
+
+
+def load(listname, language, shape='long', dense=True, articles=None, granularity='daily', path=None):
+    """
+    Load the pageviews of a list in a language
+    :param str shape: long (columns article, date, views, language, like `data/GDPR_de.csv`) or wide (dates x
+        articles, like update_keywords.request)
+    :param bool dense: long shape only, add rows with NaN views for the fetched days without data
+    :param list articles: articles to load, default: all
+    """
+    if shape not in shapes:
+        raise ValueError(f'shape must be one of {shapes}, got "{shape}"')
+
+    df = read_rows(listname, language, granularity, path)
+    fetched = load_fetched(listname, language, granularity, path)
+    if articles is not None:
+        articles = set(map(str, articles))
+        df = df[df.article.isin(articles)]
+        fetched = {a: ranges for a, ranges in fetched.items() if a in articles}
+
+    if shape == 'wide':
+        wide = df.pivot(index='date', columns='article', values='views')
+        # Articles without any data and days without any views are columns and rows of NaN
+        index = wide.index.union(pd.DatetimeIndex(fetched_grid(fetched, granularity).date.unique()))
+        columns = list(fetched) + [a for a in wide.columns if a not in fetched]
+        wide = wide.reindex(index=index, columns=columns)
+        wide.index.name = None
+        wide.columns.name = None
+        return wide
+
+    if dense:
+        # Rows of the fetched days without data, with NaN views
+        df = fetched_grid(fetched, granularity).merge(df, on=['article', 'date'], how='outer')
+    df = df.sort_values(['article', 'date']).reset_index(drop=True)
+    df['language'] = language
+    return df
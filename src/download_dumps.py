@@ -4,14 +4,22 @@ import os
 import os.path
 import argparse
 import requests
+import threading
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
-from time import sleep
+from time import sleep, monotonic
 import random
+import json
+import hashlib
+from catalog import Catalog
 
 
 path_data = '/media/maousi/Raw/ada-wiki/dumps'
 N_parallel = 3
+# Checksums of the files before they were kept in the catalog, imported into a new catalog
+manifest_path = os.path.join(path_data, 'manifest.json')
+catalog_path = os.path.join(path_data, 'catalog.sqlite')
 
 base_url = 'https://dumps.wikimedia.org/other/pagecounts-raw/'
 filename_pattern = 'pagecounts-{}-{}.gz'
@@ -54,41 +62,156 @@ def generate_download_links(start, end):
         yield file, url + file
 
 
-def download_file(url, output_path):
+chunk_size = 2**20
+
+
+def open_catalog():
+    """Catalog of the dump files, see catalog.py. A new catalog is filled with the files already downloaded, and with
+    their checksums recorded in `manifest_path` by former versions of the scripts."""
+    catalog = Catalog(catalog_path)
+    if catalog.created:
+        checksums = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                checksums = json.load(f)
+        catalog.import_directory(path_data, checksums)
+    return catalog
+
+
+def make_session(pool_size=N_parallel):
+    """Session shared by the download threads, keeps up to `pool_size` connections to dumps.wikimedia.org alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Progress:
+    """Thread-safe count of the downloaded files and bytes, printed at most every `interval` seconds"""
+    def __init__(self, n_files, interval=10):
+        self.n_files = n_files
+        self.interval = interval
+        self.done = 0
+        self.bytes = 0
+        self.start = self.last_print = monotonic()
+        self.lock = threading.Lock()
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+            if monotonic() - self.last_print >= self.interval:
+                self.print()
+
+    def file_done(self):
+        with self.lock:
+            self.done += 1
+            self.print()
+
+    def print(self):
+        self.last_print = monotonic()
+        elapsed = self.last_print - self.start
+        print(f'{self.done}/{self.n_files} files, {self.bytes / 2**20:.0f} MB in {elapsed:.0f} s '
+              f'({self.bytes / 2**20 / max(elapsed, 1e-3):.1f} MB/s)')
+
+
+def file_md5(fp, md5=None):
+    """Update `md5` (a new hashlib.md5 by default) with the content of the file, read by chunks"""
+    md5 = md5 or hashlib.md5()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5
+
+
+def download_file(url, output_path, session=None, progress=None, catalog=None):
+    """
+    Stream `url` to `output_path` in chunks of `chunk_size` bytes, such that memory does not depend on the file size.
+    Data is written to `output_path + '.part'`, renamed to `output_path` once complete: an interrupted download never
+    leaves a truncated file at `output_path`, and the next call resumes it with an HTTP Range request.
+    Return the status code of the response, `output_path` is only created on success.
+    If a catalog.Catalog is given, the file is marked as downloaded in it, along with its MD5 checksum computed while
+    writing, which spares check_hashes.py from reading the file again.
+    """
     if os.path.exists(output_path):
         raise ValueError('Should not exist.')
 
+    session = session or requests
+    part_path = output_path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+
     # Avoid error "503 Service temporarily unavailable"
     # https://stackoverflow.com/questions/52978264/503-error-when-downloading-wikipedia-dumps
     sleep(random.random() * 2)
 
-    r = requests.get(url)
-    with open(output_path, 'wb') as f:
-        f.write(r.content)
-
-    print(f'Downloaded {os.path.basename(output_path)}')
+    start = monotonic()
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=60) as r:
+            complete = r.status_code == 416 and offset > 0
+            if r.status_code not in (200, 206) and not complete:
+                print(f'ERROR {r.status_code} while downloading {url}')
+                return r.status_code
+
+            # A server ignoring the Range header sends the whole file again
+            mode = 'ab' if r.status_code == 206 or complete else 'wb'
+            md5 = None
+            if catalog is not None:
+                md5 = file_md5(part_path) if mode == 'ab' else hashlib.md5()
+            # 416: the partial file is already complete, nothing to append
+            expected = None if complete else r.headers.get('Content-Length')
+            written = 0
+            if not complete:
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size):
+                        f.write(chunk)
+                        if md5 is not None:
+                            md5.update(chunk)
+                        written += len(chunk)
+                        if progress is not None:
+                            progress.add_bytes(len(chunk))
+    except requests.RequestException as e:
+        # Keep the partial file to resume it later
+        print(f'ERROR while downloading {url}: {e}')
+        return None
+
+    if expected is not None and written != int(expected):
+        # Connection closed early, keep the partial file to resume it later
+        print(f'ERROR incomplete download of {url}: {written}/{expected} bytes')
+        return None
+
+    os.replace(part_path, output_path)
+    if catalog is not None:
+        catalog.set_status(os.path.basename(output_path), 'downloaded', output_path, md5=md5.hexdigest(),
+                           verified=None, download_seconds=monotonic() - start)
+    if progress is not None:
+        progress.file_done()
+    else:
+        print(f'Downloaded {os.path.basename(output_path)}')
 
     return r.status_code
 
 
 def main():
-    pending = generate_download_links(start, end)
-    downloaded = os.listdir(path_data)
+    links = dict(generate_download_links(start, end))
+    catalog = open_catalog()
+    catalog.add(links.items())
 
-    # Remove downloaded files from pending list
-    pending = filter(
-        lambda elem: elem[0] not in downloaded,
-        pending
-    )
-
-    pending = list(pending)
+    # Files not downloaded yet
+    pending = [(fname, links[fname]) for fname in catalog.files('pending') if fname in links]
     N = len(pending)
     print(f'{N} files to be downloaded...')
 
+    session = make_session(N_parallel)
+    progress = Progress(N)
     with ThreadPoolExecutor(N_parallel) as executor:
-        f = lambda e: download_file(e[1], os.path.join(path_data, e[0]))
+        f = lambda e: download_file(e[1], os.path.join(path_data, e[0]), session, progress, catalog)
         status_codes = list(executor.map(f, pending))
 
+    failed = sum(code not in (200, 206, 416) for code in status_codes)
+    if failed > 0:
+        print(f'{failed} files failed, run again to retry (partial downloads are resumed)')
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,146 @@
+"""
+Parser of the hourly pagecounts dumps with pyarrow, used by aggregate_dumps.py instead of pandas.read_csv.
+
+Each line of a dump is `domain article views bytes`, separated by single spaces. The lines are parsed by the
+multithreaded CSV reader of Arrow, straight into typed columns, without quoting: quotes are ordinary characters of
+article names. Malformed lines are skipped and counted rather than failing the whole file:
+
+    - lines without exactly 4 fields (e.g. a space in the article name, a truncated last line)
+    - lines with an empty article
+    - lines whose views are not an integer
+    - article names that are not valid UTF-8 are decoded with replacement characters
+
+Unlike pandas.read_csv, article names such as `NaN`, `null` or `N/A` are kept as they are.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.compute as pc
+
+
+columns = ['domain', 'article', 'views', 'bytes']
+
+# Size of the blocks parsed in parallel by the threads of Arrow, bounds the memory used by the lines of other domains
+block_size = 2**22
+
+# Views that fit in an int64
+views_pattern = r'^[0-9]{1,18}$'
+
+
+class BadLines:
+    """Counter of the lines skipped while parsing a file, see parse_dump_file"""
+    def __init__(self):
+        self.count = 0
+        self.examples = []
+
+    def __call__(self, row):
+        self.count += 1
+        if len(self.examples) < 5:
+            self.examples.append(row.text)
+        return 'skip'
+
+    def add(self, n, examples=()):
+        self.count += n
+        self.examples = (self.examples + list(examples))[:5]
+
+
+def read_options():
+    return csv.ReadOptions(column_names=columns, block_size=block_size, use_threads=True)
+
+
+def parse_options(bad_lines):
+    return csv.ParseOptions(delimiter=' ', quote_char=False, escape_char=False, double_quote=False,
+                            newlines_in_values=False, ignore_empty_lines=True, invalid_row_handler=bad_lines)
+
+
+def convert_options(views_type):
+    return csv.ConvertOptions(
+        include_columns=['domain', 'article', 'views'],
+        column_types={'domain': pa.string(), 'article': pa.binary(), 'views': views_type},
+        # Only empty fields are null, article names like NaN or null are kept
+        null_values=[''], strings_can_be_null=True, quoted_strings_can_be_null=False,
+    )
+
+
+def scan(fp, bad_lines, views_type, domains=None):
+    """Stream the blocks of the file through the CSV reader of Arrow, keep the lines of `domains` if given"""
+    reader = csv.open_csv(pa.input_stream(fp, compression='gzip'), read_options(), parse_options(bad_lines),
+                          convert_options(views_type))
+    domains = pa.array(list(domains), pa.string()) if domains is not None else None
+    batches = []
+    for batch in reader:
+        if domains is not None:
+            # Only the kept lines of a block stay in memory
+            batch = batch.filter(pc.is_in(batch.column('domain'), domains))
+        batches.append(batch)
+    return pa.Table.from_batches(batches, reader.schema)
+
+
+def read_table(fp, bad_lines, domains=None):
+    """Parse with integer views, or as strings if some views are not integers, which are then filtered out"""
+    # Lines skipped by a failed attempt are skipped again by the next one
+    attempt = BadLines()
+    try:
+        table = scan(fp, attempt, pa.int64(), domains)
+        bad_lines.add(attempt.count, attempt.examples)
+        return table
+    except pa.ArrowInvalid as e:
+        # Column #2 is views
+        if 'column #2' not in str(e):
+            raise
+    table = scan(fp, bad_lines, pa.string(), domains)
+    valid = pc.fill_null(pc.match_substring_regex(table.column('views'), views_pattern), False)
+    n_valid = pc.sum(valid).as_py() or 0
+    bad_lines.add(len(table) - n_valid)
+    table = table.filter(valid)
+    return table.set_column(2, 'views', pc.cast(table.column('views'), pa.int64()))
+
+
+def decode_articles(articles):
+    """Arrow string array of the article names, decoded with replacement characters if some are not valid UTF-8"""
+    try:
+        return pc.cast(articles, pa.string())
+    except pa.ArrowInvalid:
+        values = articles.to_pylist()
+        return pa.array([v.decode('utf-8', errors='replace') if v is not None else None for v in values],
+                        pa.string())
+
+
+def to_frame(table, bad_lines):
+    """pandas.DataFrame with columns domain, article, views of the valid lines of the table"""
+    valid = pc.and_(pc.is_valid(table.column('domain')), pc.is_valid(table.column('article')))
+    valid = pc.and_(valid, pc.is_valid(table.column('views')))
+    n_valid = pc.sum(valid).as_py() or 0
+    if n_valid < len(table):
+        bad_lines.add(len(table) - n_valid)
+        table = table.filter(valid)
+
+    return pd.DataFrame({
+        'domain': table.column('domain').to_pandas(),
+        'article': decode_articles(table.column('article')).to_pandas(),
+        'views': table.column('views').to_numpy().astype(np.int64),
+    })
+
+
+def empty_frame():
+    return pd.DataFrame({
+        'domain': pd.Series([], dtype=str), 'article': pd.Series([], dtype=str), 'views': np.zeros(0, np.int64)
+    })
+
+
+def parse_dump_file(fp, domains=None, bad_lines=None):
+    """
+    Parse a gzip-compressed dump file. Arrow decompresses it and parses it by blocks of `block_size` bytes in
+    parallel, the lines of other domains are dropped block by block.
+    :param list domains: domains to keep, default: all
+    :param BadLines bad_lines: counter of the skipped lines, default: a new one. Malformed lines of other domains
+        are counted too.
+    :return: pandas.DataFrame with columns domain, article, views
+    """
+    bad_lines = bad_lines if bad_lines is not None else BadLines()
+    table = read_table(fp, bad_lines, domains)
+    if len(table) == 0:
+        return empty_frame()
+    return to_frame(table, bad_lines)
@@ -0,0 +1,381 @@
+"""
+Columnar store of the daily aggregated dump data, see `aggregate_dumps.py --format parquet`.
+
+Article names are replaced by integer ids, from an append-only dictionary per domain: the n-th line of
+`{path_store}/_ids/domain={domain}.txt` is the article of id n. Ids never change once assigned, such that all days
+share them and can be joined or summed on integers (see ArticleIds). Writers load the whole dictionary of a domain
+to assign ids, readers only search it (lookup_article_ids, decode_article_ids).
+
+Each (domain, day) is a Parquet file in a hive-style partition, with sorted article ids and integer views:
+
+    {path_store}/domain=de/date=20150401/part.parquet
+
+Readers only open the partitions and columns they need, e.g. the German articles of April 2015:
+
+    df = read_store(domains=['de'], days=[f'201504{d:02}' for d in range(1, 31)], articles=keywords)
+
+Partitions are written in row groups of `row_group_size` rows. Since article ids are sorted, the first and last id
+of each row group are enough to locate the rows of an article. They are recorded in an index, one JSON line per
+partition in `{path_store}/_index/domain={domain}.jsonl`:
+
+    {"date": "20150401", "written": 1606912345.1, "groups": [[0, 70211], [70212, 4517736]]}
+
+read_articles uses it to read only the row groups that can contain the requested articles, without opening the
+other partitions.
+"""
+
+import os
+import json
+import bisect
+import fcntl
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+path_store = '/media/maousi/Raw/ada-wiki/store'
+row_group_size = 2**16
+
+partitioning = ds.partitioning(pa.schema([('domain', pa.string()), ('date', pa.string())]), flavor='hive')
+
+
+def partition_path(domain, day, path=None):
+    return os.path.join(path or path_store, f'domain={domain}', f'date={day}', 'part.parquet')
+
+
+def ids_path(domain, path=None):
+    return os.path.join(path or path_store, '_ids', f'domain={domain}.txt')
+
+
+class ArticleIds:
+    """Append-only dictionary article name <-> integer id of a domain, see get_article_ids.
+    Several processes (e.g. pipeline.py and aggregate_dumps.py) may assign ids at the same time: new ids are appended
+    under an exclusive lock of the file (flock), after reading the ids appended by the other processes.
+    The whole dictionary is loaded in memory as Python strings (~10 s and 2 GB for 10M articles): only writers need it,
+    use lookup_article_ids and decode_article_ids to read a few articles."""
+    def __init__(self, domain, path=None):
+        self.fp = ids_path(domain, path)
+        self.articles = []
+        self.ids = {}
+        self.size = 0   # bytes of the file read so far
+        self.lock = threading.Lock()
+        with self.lock:
+            self.refresh()
+
+    def __len__(self):
+        return len(self.articles)
+
+    def read_new(self, f, exclusive=False):
+        """Read the ids appended to the open file `f` since the last read, the file being locked"""
+        f.seek(self.size)
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data) and exclusive:
+            # Incomplete last line of a process interrupted while appending
+            f.truncate(self.size + end)
+        # Dump lines never contain line breaks, any other character of the names is kept
+        for article in data[:end].decode('utf-8').split('\n')[:-1]:
+            self.ids[article] = len(self.articles)
+            self.articles.append(article)
+        self.size += end
+
+    def refresh(self):
+        """Read the ids assigned by other processes, self.lock being held"""
+        if not os.path.exists(self.fp) or os.path.getsize(self.fp) == self.size:
+            return
+        with open(self.fp, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            self.read_new(f)
+
+    def encode(self, articles):
+        """numpy array of the ids of `articles`, new articles get new ids"""
+        articles = pd.Series(articles, dtype=object).astype(str)
+        with self.lock:
+            new = [a for a in articles.unique() if a not in self.ids]
+            if new:
+                os.makedirs(os.path.dirname(self.fp), exist_ok=True)
+                with open(self.fp, 'a+b') as f:
+                    # Released when the file is closed
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    self.read_new(f, exclusive=True)
+                    new = [a for a in new if a not in self.ids]
+                    f.write(''.join(a + '\n' for a in new).encode('utf-8'))
+                    f.flush()
+                    self.read_new(f, exclusive=True)
+            return articles.map(self.ids).values.astype(np.int64)
+
+    def lookup(self, articles):
+        """Dict article -> id of the `articles` that have an id"""
+        with self.lock:
+            self.refresh()
+            return {a: self.ids[a] for a in map(str, articles) if a in self.ids}
+
+    def decode(self, ids):
+        """numpy array of the article names of `ids`"""
+        ids = np.asarray(ids, dtype=np.int64)
+        with self.lock:
+            if len(ids) > 0 and ids.max() >= len(self.articles):
+                self.refresh()
+            return np.array([self.articles[i] for i in ids], dtype=object)
+
+
+article_ids = {}
+article_ids_lock = threading.Lock()
+
+
+def get_article_ids(domain, path=None):
+    """ArticleIds of the domain, loaded once per process"""
+    key = (domain, path or path_store)
+    with article_ids_lock:
+        if key not in article_ids:
+            article_ids[key] = ArticleIds(domain, path)
+        return article_ids[key]
+
+
+def read_ids_file(domain, path=None):
+    """Arrow array of the lines of the dictionary of a domain (article name and line break), the n-th being the
+    article of id n. Lines are sliced from the bytes of the file, without creating a Python string per article."""
+    fp = ids_path(domain, path)
+    data = b''
+    if os.path.exists(fp):
+        with open(fp, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            data = f.read()
+    data = np.frombuffer(data, dtype=np.uint8)
+    # An incomplete last line is ignored
+    ends = np.flatnonzero(data == ord('\n')) + 1
+    offsets = np.concatenate([[0], ends]).astype(np.int64)
+    return pa.Array.from_buffers(pa.large_binary(), len(ends), [None, pa.py_buffer(offsets), pa.py_buffer(data)])
+
+
+def loaded_article_ids(domain, path=None):
+    """ArticleIds of the domain if already loaded by this process, else None"""
+    with article_ids_lock:
+        return article_ids.get((domain, path or path_store))
+
+
+def lookup_article_ids(domain, articles, path=None):
+    """Dict article -> id of the `articles` of the domain that have an id, searched in the dictionary file unless
+    already loaded by this process"""
+    loaded = loaded_article_ids(domain, path)
+    if loaded is not None:
+        return loaded.lookup(articles)
+    lines = read_ids_file(domain, path)
+    values = pa.array([(a + '\n').encode('utf-8') for a in set(map(str, articles))], type=pa.large_binary())
+    ids = np.flatnonzero(pc.is_in(lines, value_set=values).to_numpy(zero_copy_only=False))
+    return {line[:-1].decode('utf-8'): int(i) for line, i in zip(lines.take(ids).to_pylist(), ids)}
+
+
+def decode_article_ids(domain, ids, path=None):
+    """numpy array of the article names of `ids` of the domain, read from the dictionary file unless already loaded
+    by this process"""
+    loaded = loaded_article_ids(domain, path)
+    if loaded is not None:
+        return loaded.decode(ids)
+    lines = read_ids_file(domain, path).take(pa.array(np.asarray(ids, dtype=np.int64)))
+    return np.array([line[:-1].decode('utf-8') for line in lines.to_pylist()], dtype=object)
+
+
+def index_path(domain, path=None):
+    return os.path.join(path or path_store, '_index', f'domain={domain}.jsonl')
+
+
+# Days are saved by several threads, see aggregate_dumps.aggregate_days_parallel
+index_lock = threading.Lock()
+
+
+def row_groups_bounds(ids):
+    """[first, last] article id of every row group of a partition, `ids` being its sorted article ids"""
+    return [
+        [int(ids[i]), int(ids[min(i + row_group_size, len(ids)) - 1])]
+        for i in range(0, len(ids), row_group_size)
+    ]
+
+
+def append_index(domain, day, groups, path=None):
+    fp = index_path(domain, path)
+    line = json.dumps({'date': day, 'written': time(), 'groups': groups}) + '\n'
+    with index_lock:
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        with open(fp, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def load_index_entries(domain, path=None):
+    """Dict day -> index entry {'date', 'written', 'groups'} of the partitions of `domain`,
+    the last one written if a day was rewritten"""
+    fp = index_path(domain, path)
+    if not os.path.exists(fp):
+        return {}
+
+    entries = {}
+    with open(fp, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Interrupted while appending
+                continue
+            entry = json.loads(line)
+            if entry['date'] not in entries or entry['written'] >= entries[entry['date']]['written']:
+                entries[entry['date']] = entry
+    return entries
+
+
+def load_index(domain, path=None):
+    """Dict day -> row group bounds of the partitions of `domain`"""
+    return {day: entry['groups'] for day, entry in load_index_entries(domain, path).items()}
+
+
+def rebuild_index(domains, path=None):
+    """Index the partitions of `domains` from their content, e.g. if the index was lost"""
+    for domain in domains:
+        fp = index_path(domain, path)
+        if os.path.exists(fp):
+            os.remove(fp)
+        domain_path = os.path.join(path or path_store, f'domain={domain}')
+        for partition in sorted(os.listdir(domain_path)):
+            day = partition.split('=')[1]
+            f = pq.ParquetFile(partition_path(domain, day, path))
+            groups = []
+            for i in range(f.num_row_groups):
+                ids = f.read_row_group(i, columns=['article_id']).column('article_id').to_numpy()
+                if len(ids) > 0:
+                    groups.append([int(ids[0]), int(ids[-1])])
+            append_index(domain, day, groups, path)
+
+
+def sum_by_id(ids, views):
+    """Sum `views` by article id with np.bincount, rather than a groupby on strings.
+    Return the sorted distinct ids and their total views."""
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    present = np.bincount(ids) > 0
+    totals = np.bincount(ids, weights=views)
+    unique_ids = np.flatnonzero(present)
+    # Sums of views are far below 2**53, float64 sums are exact
+    return unique_ids, totals[unique_ids].astype(np.int64)
+
+
+def write_day(df, day, domains, path=None):
+    """Write the aggregated data of a day (columns domain, article_id, views, one row per article) in one partition
+    per domain, and index it. Every domain of `domains` gets a partition, possibly empty, such that the day is known
+    to be complete."""
+    for domain in domains:
+        sub = df[df.domain == domain].sort_values('article_id')
+        ids = sub.article_id.values
+        table = pa.table({
+            'article_id': pa.array(ids, pa.int32()),
+            'views': pa.array(sub.views.values, pa.int64()),
+        })
+
+        fp = partition_path(domain, day, path)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        # Write then rename, such that an interrupted run never leaves a truncated partition
+        tmp = fp + '.tmp'
+        pq.write_table(table, tmp, compression='zstd', row_group_size=row_group_size)
+        os.replace(tmp, fp)
+        append_index(domain, day, row_groups_bounds(ids), path)
+
+
+def is_day_stored(day, domains, path=None):
+    return all(os.path.exists(partition_path(domain, day, path)) for domain in domains)
+
+
+def partition_domains(path=None):
+    return [d.split('=')[1] for d in os.listdir(path or path_store) if d.startswith('domain=')]
+
+
+def add_article_names(df, path=None):
+    """Insert a column article before the column article_id, with the article names of each domain"""
+    articles = np.empty(len(df), dtype=object)
+    for domain in df.domain.unique():
+        mask = (df.domain == domain).values
+        articles[mask] = decode_article_ids(domain, df.article_id.values[mask], path)
+    df.insert(df.columns.get_loc('article_id'), 'article', articles)
+    return df
+
+
+def read_store(domains=None, days=None, articles=None, columns=None, path=None):
+    """
+    Load the aggregated data as a pandas.DataFrame with columns domain, article, article_id, views and date
+    ('YYYYMMDD')
+    :param list domains: domains to load, default: all
+    :param list days: days to load, default: all
+    :param list articles: articles to load, default: all
+    :param list columns: columns to load among domain, article_id, views and date, default: all. The column
+        article is added if domain and article_id are loaded.
+    :param str path: root of the store, default: `path_store`
+    """
+    dataset = ds.dataset(path or path_store, format='parquet', partitioning=partitioning, exclude_invalid_files=True)
+
+    filters = []
+    if domains is not None:
+        filters.append(ds.field('domain').isin(list(domains)))
+    if days is not None:
+        filters.append(ds.field('date').isin(list(days)))
+    if articles is not None:
+        # Each domain has its own ids
+        by_domain = ds.scalar(False)
+        for domain in domains if domains is not None else partition_domains(path):
+            ids = list(lookup_article_ids(domain, articles, path).values())
+            by_domain = by_domain | ((ds.field('domain') == domain) & ds.field('article_id').isin(ids))
+        filters.append(by_domain)
+
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    if 'domain' in df.columns and 'article_id' in df.columns:
+        df['domain'] = df.domain.astype(str)
+        add_article_names(df, path)
+    return df
+
+
+def matching_row_groups(groups, ids):
+    """Indices of the row groups whose [first, last] bounds contain at least one of the sorted `ids`"""
+    matches = []
+    for i, (first, last) in enumerate(groups):
+        j = bisect.bisect_left(ids, first)
+        if j < len(ids) and ids[j] <= last:
+            matches.append(i)
+    return matches
+
+
+def read_row_groups(domain, day, row_groups, ids, path=None):
+    df = pq.ParquetFile(partition_path(domain, day, path)).read_row_groups(row_groups).to_pandas()
+    df = df[df.article_id.isin(ids)]
+    df.insert(0, 'domain', domain)
+    df['date'] = day
+    return df
+
+
+def read_articles(articles, domains, days=None, path=None, n_threads=8):
+    """
+    Load the rows of `articles` with the index, as a pandas.DataFrame with columns domain, article, article_id,
+    views and date. Only the row groups that can contain the articles are read.
+    :param list articles: articles to load
+    :param list domains: domains to load
+    :param list days: days to load, default: all the indexed days
+    """
+    tasks = []
+    for domain in domains:
+        ids = sorted(lookup_article_ids(domain, articles, path).values())
+        for day, groups in sorted(load_index(domain, path).items()):
+            if days is not None and day not in days:
+                continue
+            row_groups = matching_row_groups(groups, ids)
+            if row_groups:
+                tasks.append((domain, day, row_groups, ids))
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        parts = list(executor.map(lambda t: read_row_groups(*t, path), tasks))
+
+    if not parts:
+        return pd.DataFrame({'domain': [], 'article': [], 'article_id': [], 'views': [], 'date': []})
+    return add_article_names(pd.concat(parts, ignore_index=True), path)
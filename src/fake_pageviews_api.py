@@ -0,0 +1,337 @@
+"""
+Local stand-in for the Wikimedia Pageviews REST API, used to benchmark and test the scraping code without
+hitting wikimedia.org. It answers the `per-article`, `aggregate` and `top` endpoints of
+`scrape_wiki.endpoints` with deterministic, made-up view counts.
+
+It also answers title queries and searches of the MediaWiki action API (`/{domain}.wikipedia.org/w/api.php`, see
+resolve_titles.py), with made-up rules: titles are normalized like MediaWiki does (underscores to spaces, first letter
+in upper case), `X (redirect)` redirects to `X`, titles starting with `Missing` do not exist, and every article has
+language links `X (en)`, `X (fr)`, ... to the other languages of `fake_langs`.
+
+View counts are shaped like a real dataset (by default `data/GDPR_de.csv`): the mean daily views of each fake
+article is drawn from the means of the articles of the dataset, and there is no data before the first day with
+data in the dataset, like in the real API (July 2015). Latency, server errors and throttling (HTTP 429 with a
+Retry-After header) can be injected.
+
+Usage:
+    $ python3 src/fake_pageviews_api.py --port 8080 --latency 0.05 --throttle-rate 0.01
+    >>> p = PageviewsClient(contact, api_root='http://127.0.0.1:8080')
+"""
+
+import os
+import csv
+import json
+import zlib
+import random
+import argparse
+import threading
+import multiprocessing
+from time import sleep
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlparse, parse_qs
+
+
+profile_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'GDPR_de.csv')
+
+
+def load_profile(fp=profile_path):
+    """Read a long-format pageviews dataset (columns article, date, views),
+    return the sorted mean daily views of its articles and the first day with data ('YYYYMMDD00')"""
+    sums, counts = {}, {}
+    first_day = None
+    with open(fp, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if row['views'] == '':
+                continue
+            sums[row['article']] = sums.get(row['article'], 0) + float(row['views'])
+            counts[row['article']] = counts.get(row['article'], 0) + 1
+            day = row['date'].replace('-', '') + '00'
+            first_day = day if first_day is None else min(first_day, day)
+
+    means = sorted(sums[a] / counts[a] for a in sums)
+    return means, first_day
+
+
+class Profile:
+    """Shape of the fake time series"""
+    def __init__(self, means=None, first_day='2015070100'):
+        self.means = means or [100]
+        self.first_day = first_day
+
+    def views(self, name, timestamp, scale=1):
+        """Deterministic view count of article/project `name` at `timestamp`"""
+        mean = self.means[zlib.crc32(name.encode('utf-8')) % len(self.means)] * scale
+        noise = zlib.crc32((name + timestamp).encode('utf-8')) % 1000 / 1000
+        return int(mean * (0.5 + noise))
+
+
+def fake_timestamps(granularity, start, end):
+    start = datetime.strptime(start.ljust(10, '0'), '%Y%m%d%H')
+    end = datetime.strptime(end.ljust(10, '0'), '%Y%m%d%H')
+    if granularity == 'monthly':
+        start = datetime(start.year, start.month, 1)
+    while start <= end:
+        yield start.strftime('%Y%m%d%H')
+        if granularity == 'hourly':
+            start += timedelta(hours=1)
+        elif granularity == 'monthly':
+            start = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        else:
+            start += timedelta(days=1)
+
+
+def per_article(profile, project, access, agent, article, granularity, start, end):
+    scale = 30 if granularity == 'monthly' else 1
+    return [
+        {'project': project, 'article': article, 'granularity': granularity, 'timestamp': ts,
+         'access': access, 'agent': agent, 'views': profile.views(article, ts, scale)}
+        for ts in fake_timestamps(granularity, start, end)
+        if ts >= profile.first_day
+    ]
+
+
+def aggregate(profile, project, access, agent, granularity, start, end):
+    scale = {'hourly': 1e4 / 24, 'daily': 1e4, 'monthly': 3e5}.get(granularity, 1e4)
+    return [
+        {'project': project, 'access': access, 'agent': agent, 'granularity': granularity,
+         'timestamp': ts, 'views': profile.views(project, ts, scale)}
+        for ts in fake_timestamps(granularity, start, end)
+        if ts >= profile.first_day
+    ]
+
+
+def top(profile, project, access, year, month, day, n_articles=1000):
+    if year + month + ('01' if day == 'all-days' else day) + '00' < profile.first_day:
+        return []
+    scale = 30 if day == 'all-days' else 1
+    articles = [
+        {'article': f'Article_{i}', 'views': 100 * (n_articles - i) + profile.views(str(i), year + month + day, scale)}
+        for i in range(n_articles)
+    ]
+    articles.sort(key=lambda a: -a['views'])
+    for rank, a in enumerate(articles, start=1):
+        a['rank'] = rank
+    return [
+        {'project': project, 'access': access, 'year': year, 'month': month, 'day': day, 'articles': articles}
+    ]
+
+
+fake_langs = ['en', 'de', 'fr', 'es', 'it']
+
+# Characters forbidden in MediaWiki titles
+invalid_chars = set('#<>[]{}')
+
+
+def fake_normalize(title):
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def fake_redirect(title):
+    return title[:-len(' (redirect)')] if title.endswith(' (redirect)') else None
+
+
+def action_query(domain, params, langlinks_limit=500):
+    """Answer of the action API to a query of titles (prop=langlinks, redirects) or a search (list=search), in
+    formatversion 2"""
+    if params.get('list') == 'search':
+        term = params.get('srsearch', '')
+        results = [] if term.startswith('Missing') else [{'ns': 0, 'title': fake_normalize(term)}]
+        return {'batchcomplete': True, 'query': {'search': results[:int(params.get('srlimit', 10))]}}
+
+    response = {'batchcomplete': True}
+    titles = params['titles'].split('|') if params.get('titles') else []
+    if len(titles) > 50:
+        response['warnings'] = {'main': {'warnings': 'Too many values supplied for parameter "titles". The limit '
+                                                     'is 50.'}}
+        titles = titles[:50]
+
+    normalized, redirects, pages = [], [], {}
+    for title in titles:
+        if invalid_chars & set(title) or not title.strip():
+            pages[title] = {'title': title, 'invalidreason': 'The requested page title is invalid.', 'invalid': True}
+            continue
+        current = fake_normalize(title)
+        if current != title:
+            normalized.append({'fromencoded': False, 'from': title, 'to': current})
+        target = fake_redirect(current) if 'redirects' in params else None
+        if target is not None:
+            redirects.append({'from': current, 'to': target})
+            current = target
+        if current.startswith('Missing'):
+            pages[current] = {'ns': 0, 'title': current, 'missing': True}
+        else:
+            pages[current] = {'pageid': zlib.crc32(current.encode('utf-8')), 'ns': 0, 'title': current}
+
+    if params.get('prop') == 'langlinks':
+        links = [
+            (page, {'lang': lang, 'title': f'{page["title"]} ({lang})'})
+            for page in pages.values() if 'pageid' in page
+            for lang in fake_langs if lang != domain and params.get('lllang', lang) == lang
+        ]
+        limit = langlinks_limit if params.get('lllimit', 'max') == 'max' else int(params['lllimit'])
+        offset = int(params.get('llcontinue', 0))
+        for page, link in links[offset:offset + limit]:
+            page.setdefault('langlinks', []).append(link)
+        if offset + limit < len(links):
+            response['continue'] = {'llcontinue': str(offset + limit), 'continue': '||'}
+            del response['batchcomplete']
+
+    query = {'pages': list(pages.values())}
+    if normalized:
+        query['normalized'] = normalized
+    if redirects:
+        query['redirects'] = redirects
+    response['query'] = query
+    return response
+
+
+routes = {
+    'per-article': (7, per_article),
+    'aggregate': (6, aggregate),
+    'top': (5, top),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive, like the real API
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately, Nagle's algorithm would delay the body of kept-alive connections
+    disable_nagle_algorithm = True
+
+    # Overridden by `serve`
+    profile = Profile()
+    latency = 0
+    error_rate = 0
+    throttle_rate = 0
+    retry_after = 1
+    langlinks_limit = 500
+
+    def do_GET(self):
+        if self.latency > 0:
+            # Exponentially distributed, such that there is a tail of slow requests
+            sleep(random.expovariate(1 / self.latency))
+
+        r = random.random()
+        if r < self.throttle_rate:
+            return self.send_json(429, {'title': 'Too Many Requests'}, {'Retry-After': str(self.retry_after)})
+        if r < self.throttle_rate + self.error_rate:
+            return self.send_json(503, {'title': 'Service Unavailable'})
+
+        url = urlparse(self.path)
+        if url.path.endswith('/w/api.php'):
+            # /{domain}.wikipedia.org/w/api.php
+            host = url.path.strip('/').split('/')[-3] if url.path.count('/') >= 3 else 'en'
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            return self.send_json(200, action_query(host.split('.')[0], params, self.langlinks_limit))
+
+        parts = [unquote(p) for p in self.path.strip('/').split('/')]
+        # The endpoint name is followed by its parameters, anything before it is the API root
+        endpoint = next((i for i, p in enumerate(parts) if p in routes), None)
+        if endpoint is None or len(parts) - endpoint - 1 != routes[parts[endpoint]][0]:
+            return self.send_json(404, {'title': 'Not found.', 'uri': self.path})
+
+        f = routes[parts[endpoint]][1]
+        items = f(self.profile, *parts[endpoint + 1:])
+        if len(items) == 0:
+            # Same answer as the real API for dates without data
+            return self.send_json(404, {'title': 'Not found.', 'uri': self.path})
+        self.send_json(200, {'items': items})
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    # The default backlog (5) drops connections when many clients connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def make_server(host='127.0.0.1', port=0, profile=None, latency=0, error_rate=0, throttle_rate=0, retry_after=1):
+    """
+    :param profile: Profile of the fake time series, default: shaped like data/GDPR_de.csv
+    :param float latency: mean latency added to each request, in seconds
+    :param float error_rate: fraction of requests answered with HTTP 503
+    :param float throttle_rate: fraction of requests answered with HTTP 429
+    :param int retry_after: Retry-After header of HTTP 429 answers, in seconds
+    """
+    if profile is None:
+        profile = Profile(*load_profile()) if os.path.exists(profile_path) else Profile()
+
+    # Parameters are class attributes of a dedicated handler, such that several servers can run side by side
+    handler = type('ConfiguredHandler', (Handler,), dict(
+        profile=profile, latency=latency, error_rate=error_rate,
+        throttle_rate=throttle_rate, retry_after=retry_after,
+    ))
+    return Server((host, port), handler)
+
+
+def serve(host='127.0.0.1', port=0, **kwargs):
+    """Start the server in a background thread, return the server and its API root URL
+    (port 0 picks a free port), stop it with `server.shutdown()`. See make_server for the other arguments."""
+    server = make_server(host, port, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def run_server(conn, host, kwargs):
+    server = make_server(host, 0, **kwargs)
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+
+def serve_process(host='127.0.0.1', **kwargs):
+    """Same as serve, but run the server in a child process such that it does not compete with the
+    client for the GIL (nor shows up in its memory measures). Stop it with `process.terminate()`."""
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_server, args=(child, host, kwargs), daemon=True)
+    process.start()
+    port = parent.recv()
+    return process, f'http://{host}:{port}'
+
+
+def serve_processes(n_processes, host='127.0.0.1', **kwargs):
+    """Same as serve_process, but `n_processes` processes accept the connections of the same listening socket, such
+    that a single Python process does not cap the throughput of the server (requires the fork start method).
+    Return the processes and the API root URL, stop them with `process.terminate()`."""
+    server = make_server(host, 0, **kwargs)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=server.serve_forever, daemon=True) for _ in range(n_processes)]
+    for process in processes:
+        process.start()
+    # The processes have their own copy of the socket
+    server.server_close()
+    return processes, f'http://{host}:{server.server_address[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='mean latency of requests, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with HTTP 503')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests throttled (HTTP 429)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of throttled requests, in seconds')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                         throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+    print(f'Serving fake Pageviews API on http://{args.host}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
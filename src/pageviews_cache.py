@@ -0,0 +1,155 @@
+"""
+On-disk cache of the Pageviews API time series, see PageviewsClient(cache=...).
+
+Each time series (project, article, access, agent, granularity) is stored in its own JSON file along with the date
+ranges that were already fetched, such that extending a request by a few days only fetches the missing days:
+
+    {"fetched": [["20150401", "20190531"]], "views": {"2015070100": 12, ...}}
+
+Rankings of the top articles are stored in one JSON file per (project, access, period), as returned by the API.
+"""
+
+import os
+import json
+import hashlib
+from datetime import date, datetime, timedelta
+from requests.utils import quote
+
+
+def to_day(d):
+    return d.strftime('%Y%m%d')
+
+
+def from_day(s):
+    return datetime.strptime(s, '%Y%m%d').date()
+
+
+def as_date(d):
+    return date(d.year, d.month, d.day)
+
+
+def month_end(d):
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1) - timedelta(days=1)
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent inclusive ranges of 'YYYYMMDD' days"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and from_day(start) <= from_day(merged[-1][1]) + timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class PageviewsCache:
+    def __init__(self, path):
+        """
+        :param str path: directory of the cache, created if needed
+        """
+        self.path = path
+
+    def entry_path(self, project, article, access, agent, granularity):
+        fname = quote(article, safe='')
+        # File names are limited to 255 bytes on most file systems
+        if len(fname) > 200:
+            fname = hashlib.md5(article.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, project, access, agent, granularity, fname + '.json')
+
+    def load(self, *key):
+        """Load the entry of the time series `key` = (project, article, access, agent, granularity)"""
+        fp = self.entry_path(*key)
+        if not os.path.exists(fp):
+            return {'fetched': [], 'views': {}}
+        with open(fp, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, entry, *key):
+        fp = self.entry_path(*key)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        # Write then rename, such that a crash or a concurrent reader never sees a truncated file
+        tmp = f'{fp}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp, fp)
+
+    def top_path(self, project, access, year, month, day):
+        return os.path.join(self.path, project, access, 'top', f'{year}-{month}-{day}.json')
+
+    def load_top(self, project, access, year, month, day):
+        """Cached ranking of the top articles of a day (or of a month if `day` is 'all-days'), None if not cached"""
+        fp = self.top_path(project, access, year, month, day)
+        if not os.path.exists(fp):
+            return None
+        with open(fp, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_top(self, ranking, project, access, year, month, day):
+        """Cache a ranking, unless its period is too recent to be final in the API"""
+        year, month = int(year), int(month)
+        if day == 'all-days':
+            last_day = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1))
+        else:
+            last_day = date(year, month, int(day))
+        if last_day > date.today() - timedelta(days=2):
+            return
+
+        fp = self.top_path(project, access, year, str(month).rjust(2, '0'), day)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        tmp = f'{fp}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(ranking, f)
+        os.replace(tmp, fp)
+
+    @staticmethod
+    def missing_ranges(entry, startDate, endDate, granularity='daily'):
+        """List of (start, end) date ranges between `startDate` and `endDate` that are not in the cache entry.
+        Monthly series are only requested by whole months."""
+        startDate, endDate = as_date(startDate), as_date(endDate)
+        if granularity == 'monthly':
+            startDate, endDate = startDate.replace(day=1), month_end(endDate)
+        missing = []
+        cursor = startDate
+        for start, end in entry['fetched']:
+            start, end = from_day(start), from_day(end)
+            if end < cursor:
+                continue
+            if start > endDate:
+                break
+            if start > cursor:
+                missing.append((cursor, start - timedelta(days=1)))
+            cursor = end + timedelta(days=1)
+        if cursor <= endDate:
+            missing.append((cursor, endDate))
+        return missing
+
+    @staticmethod
+    def add(entry, startDate, endDate, items, granularity='daily'):
+        """Record the items fetched for the range `startDate`-`endDate` in the cache entry.
+        Days (or months) too recent to be final in the API are not marked as fetched."""
+        for item in items:
+            entry['views'][item['timestamp']] = item['views']
+
+        startDate = as_date(startDate)
+        endDate = min(as_date(endDate), date.today() - timedelta(days=2))
+        if granularity == 'monthly' and endDate != month_end(endDate):
+            endDate = endDate.replace(day=1) - timedelta(days=1)
+        if startDate <= endDate:
+            entry['fetched'] = merge_ranges(entry['fetched'] + [[to_day(startDate), to_day(endDate)]])
+
+    @staticmethod
+    def result(entry, article, startDate, endDate, granularity='daily'):
+        """Build an API-like result {'items': [...]} of the range from the cache entry,
+        without 'items' if the range was never fetched successfully"""
+        if len(entry['fetched']) == 0 and len(entry['views']) == 0:
+            return {}
+
+        if granularity == 'monthly':
+            startDate = startDate.replace(day=1)
+        start, end = startDate.strftime('%Y%m%d00'), endDate.strftime('%Y%m%d23')
+        return {'items': [
+            {'article': article, 'timestamp': ts, 'views': views}
+            for ts, views in sorted(entry['views'].items())
+            if start <= ts <= end
+        ]}
@@ -0,0 +1,286 @@
+"""
+Pipelined download -> checksum verification -> aggregation of the hourly pagecounts dumps.
+
+Each hourly file goes through the stages as soon as it is ready, instead of running download_dumps.py,
+check_hashes.py and aggregate_dumps.py one after the other on the whole date range:
+
+    download (threads) -> verify (threads) -> pre-aggregate (processes) -> save complete days (thread)
+
+Stages are connected by bounded queues, such that a fast stage cannot run far ahead of a slow one, and each stage has
+its own concurrency: network, disk and CPUs are busy at the same time. Files already downloaded, verified or
+pre-aggregated skip the corresponding stages, and days already aggregated from all their hourly files are skipped.
+
+Usage:
+    $ python3 src/pipeline.py 20150401 20150430 --download 3 --verify 2 --aggregate 8 --format parquet
+"""
+
+import os
+import queue
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from collections import defaultdict
+from time import time
+from download_dumps import (
+    path_data, base_url, N_parallel, get_url_suffix, generate_download_links, make_session,
+    download_file, file_md5, Progress, open_catalog
+)
+from check_hashes import get_checksum_file, read_checksum_file
+from aggregate_dumps import (
+    output_formats, hour_partial, is_partial_valid, save_day, is_day_aggregated, load_day_record, file_stat
+)
+
+
+class Pipeline:
+    def __init__(self, start, end, n_download=N_parallel, n_verify=2, n_aggregate=None, queue_size=16,
+                 output_format='csv'):
+        """
+        :param str start: first day to process, YYYYMMDD
+        :param str end: last day to process, YYYYMMDD
+        :param int n_download: number of files downloaded at the same time
+        :param int n_verify: number of threads verifying checksums
+        :param int n_aggregate: number of processes pre-aggregating hourly files, default: number of CPUs
+        :param int queue_size: maximum number of files waiting between two stages
+        :param str output_format: see aggregate_dumps.output_formats
+        """
+        self.n_download = n_download
+        self.n_verify = n_verify
+        self.n_aggregate = n_aggregate or multiprocessing.cpu_count()
+        self.output_format = output_format
+
+        self.download_queue = queue.Queue(queue_size)
+        self.verify_queue = queue.Queue(queue_size)
+        self.aggregate_queue = queue.Queue(queue_size)
+
+        self.urls = {}
+        self.hours = defaultdict(set)   # day -> names of its hourly files not processed yet
+        self.done = defaultdict(list)   # day -> paths of its hourly files ready to be summed
+        links = defaultdict(dict)
+        for fname, url in generate_download_links(start, end):
+            links[fname.split('-')[1]][fname] = url
+        self.catalog = open_catalog()
+        for day, urls in links.items():
+            if self.is_day_done(day):
+                continue
+            self.urls.update(urls)
+            self.hours[day] = set(urls)
+
+        self.catalog.add(self.urls.items())
+        self.session = make_session(n_download + 1)
+        self.progress = Progress(len(self.urls))
+        self.checksums = {}
+        self.checksums_refreshed = set()
+        self.checksums_lock = threading.Lock()
+        self.failed = []
+        self.busy = defaultdict(float)  # stage -> seconds spent working
+        self.lock = threading.Lock()
+
+    def is_day_done(self, day):
+        """True if the day was aggregated from all its hourly files that were downloaded, unchanged or removed since.
+        Like in aggregate_dumps.get_pending_days, hours that were never downloaded (e.g. missing from the dumps) do not
+        make the day pending."""
+        if not is_day_aggregated(day, self.output_format):
+            return False
+        record = load_day_record(day, self.output_format)
+        fnames = self.catalog.files(['downloaded', 'verified', 'aggregated', 'removed'], day, day)
+        return all(
+            fname in record and (not os.path.exists(self.path(fname)) or record[fname] == file_stat(self.path(fname)))
+            for fname in fnames
+        )
+
+    def path(self, fname):
+        return os.path.join(path_data, fname)
+
+    def download(self, fname):
+        fp = self.path(fname)
+        if not os.path.exists(fp):
+            download_file(self.urls[fname], fp, self.session, self.progress, self.catalog)
+        return os.path.exists(fp)
+
+    def expected_checksum(self, fname):
+        """Published checksum of the file, None if the md5sums.txt file of its month has none"""
+        date = datetime.strptime(fname.split('-')[1], '%Y%m%d')
+        suffix = get_url_suffix(date)
+        with self.checksums_lock:
+            if suffix not in self.checksums:
+                fp = get_checksum_file(suffix, base_url + suffix + 'md5sums.txt', self.session)
+                self.checksums[suffix] = read_checksum_file(fp)
+            if fname not in self.checksums[suffix] and suffix not in self.checksums_refreshed:
+                # The local copy of the md5sums.txt file may predate the file, downloaded again once per run
+                self.checksums_refreshed.add(suffix)
+                fp = get_checksum_file(suffix, base_url + suffix + 'md5sums.txt', self.session, refresh=True)
+                self.checksums[suffix] = read_checksum_file(fp)
+            return self.checksums[suffix].get(fname)
+
+    def verify(self, fname):
+        fp = self.path(fname)
+        if self.catalog.is_verified(fname, fp):
+            if self.catalog.get(fname)['status'] == 'downloaded':
+                self.catalog.set_status(fname, 'verified')
+            return True
+
+        start = time()
+        # Usually computed while downloading
+        md5 = self.catalog.md5(fname, fp)
+        if md5 is None:
+            md5 = file_md5(fp).hexdigest()
+            self.catalog.record_md5(fname, fp, md5)
+
+        expected = self.expected_checksum(fname)
+        if expected is None:
+            # Can not be checked, kept as downloaded
+            print(f'<WARNING> no published checksum of {fname}, not verified')
+            return True
+        ok = md5 == expected
+        self.catalog.set_verified(fname, ok)
+        if not ok:
+            # Downloaded again by the next run
+            print(f'<WARNING> bad checksum of {fname}, removed')
+            os.remove(fp)
+            self.catalog.set_status(fname, 'pending')
+        else:
+            self.catalog.set_status(fname, 'verified', verify_seconds=time() - start)
+        return ok
+
+    def run_stage(self, name, f, input_queue, output_queue):
+        """Worker of a stage: apply `f` to the files of `input_queue` until None,
+        pass them on to `output_queue` if `f` returns True"""
+        while True:
+            fname = input_queue.get()
+            if fname is None:
+                return
+            start = time()
+            try:
+                ok = f(fname)
+            except Exception as e:
+                print(f'<ERROR> {name} of {fname}: {e}')
+                ok = False
+            with self.lock:
+                self.busy[name] += time() - start
+            if ok:
+                output_queue.put(fname)
+            else:
+                self.hour_done(fname, False)
+
+    def start_stage(self, name, n_workers, f, input_queue, output_queue):
+        threads = [
+            threading.Thread(target=self.run_stage, args=(name, f, input_queue, output_queue), daemon=True)
+            for _ in range(n_workers)
+        ]
+        for t in threads:
+            t.start()
+        return threads
+
+    @staticmethod
+    def stop_stage(threads, input_queue):
+        for _ in threads:
+            input_queue.put(None)
+        for t in threads:
+            t.join()
+
+    def run_aggregate(self, pool):
+        """Submit the verified files to the process pool, at most 2 * n_aggregate at a time"""
+        slots = threading.BoundedSemaphore(2 * self.n_aggregate)
+
+        def done(future, fname, start):
+            slots.release()
+            if future.exception() is not None:
+                print(f'<ERROR> aggregation of {fname}: {future.exception()}')
+            with self.lock:
+                self.busy['aggregate'] += time() - start
+            self.hour_done(fname, future.exception() is None)
+
+        while True:
+            fname = self.aggregate_queue.get()
+            if fname is None:
+                return
+            fp = self.path(fname)
+            if is_partial_valid(fp):
+                self.hour_done(fname, True)
+                continue
+            slots.acquire()
+            start = time()
+            future = pool.submit(hour_partial, fp)
+            future.add_done_callback(lambda future, fname=fname, start=start: done(future, fname, start))
+
+    def hour_done(self, fname, ok):
+        """Record the end of the processing of an hourly file, save its day once all its files are processed"""
+        day = fname.split('-')[1]
+        with self.lock:
+            self.hours[day].discard(fname)
+            if ok:
+                self.done[day].append(self.path(fname))
+            else:
+                self.failed.append(fname)
+            if self.hours[day]:
+                return
+            files_day = sorted(self.done.pop(day, []))
+            del self.hours[day]
+
+        if not files_day:
+            print(f'<WARNING> no files for date {day} <WARNING>')
+            return
+        if len(files_day) != 24:
+            print(f'<WARNING> only {len(files_day)} files for date {day} <WARNING>')
+        self.savers.submit(self.save, day, files_day)
+
+    def save(self, day, files_day):
+        start = time()
+        try:
+            parts = [hour_partial(fp, reuse=True) for fp in files_day]
+            save_day(day, parts, self.output_format, files_day, self.catalog)
+        except Exception as e:
+            print(f'<ERROR> saving day {day}: {e}')
+        with self.lock:
+            self.busy['save'] += time() - start
+
+    def run(self):
+        start = time()
+        print(f'{len(self.urls)} files in {len(self.hours)} days to process')
+        # The pool is shut down first: its last files may submit days to save
+        with ThreadPoolExecutor(1) as self.savers:
+            with ProcessPoolExecutor(self.n_aggregate) as pool:
+                downloaders = self.start_stage(
+                    'download', self.n_download, self.download, self.download_queue, self.verify_queue)
+                verifiers = self.start_stage(
+                    'verify', self.n_verify, self.verify, self.verify_queue, self.aggregate_queue)
+                aggregator = threading.Thread(target=self.run_aggregate, args=(pool,), daemon=True)
+                aggregator.start()
+
+                # Blocks while the download queue is full
+                for fname in list(self.urls):
+                    self.download_queue.put(fname)
+
+                self.stop_stage(downloaders, self.download_queue)
+                self.stop_stage(verifiers, self.verify_queue)
+                self.aggregate_queue.put(None)
+                aggregator.join()
+
+        summary = self.catalog.summary()
+        print('Catalog: ' + ', '.join(f'{n} {status} ({size / 2**30:.1f} GB)' for status, (n, size) in summary.items()))
+        print(f'Done in {time() - start:.0f} s, busy time of the stages: ' +
+              ', '.join(f'{name} {seconds:.0f} s' for name, seconds in self.busy.items()))
+        if self.failed:
+            print(f'{len(self.failed)} files failed, run again to retry:')
+            print('\n'.join(sorted(self.failed)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start', help='first day, YYYYMMDD')
+    parser.add_argument('end', help='last day, YYYYMMDD')
+    parser.add_argument('--download', type=int, default=N_parallel, help='number of parallel downloads')
+    parser.add_argument('--verify', type=int, default=2, help='number of threads verifying checksums')
+    parser.add_argument('--aggregate', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes parsing and pre-aggregating hourly files')
+    parser.add_argument('--queue-size', type=int, default=16, help='maximum number of files waiting between stages')
+    parser.add_argument('--format', choices=output_formats, default='csv', help='see aggregate_dumps.py')
+    args = parser.parse_args()
+
+    Pipeline(args.start, args.end, args.download, args.verify, args.aggregate, args.queue_size, args.format).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Instrumentation of the requests sent by PageviewsClient, see PageviewsClient(metrics=...).
+
+Every request records its latency (all retries included), response size, final status code, number of retries and
+the time it waited before being sent (thread pool queue and rate limiter). Latencies are kept in fixed histograms
+per endpoint, such that memory does not grow with the number of requests, plus the few slowest requests, to spot
+slow articles. Usage:
+
+    metrics = RequestMetrics()
+    p = PageviewsClient(contact, metrics=metrics)
+    p.article_views(...)
+    print(metrics.summary())
+"""
+
+import heapq
+import bisect
+import threading
+import pandas as pd
+from collections import Counter, defaultdict
+
+
+# Upper edges of the histogram buckets, in seconds: 0, then 1 ms to ~2 min with 4 buckets per doubling
+bucket_edges = [0] + [0.001 * 2 ** (i / 4) for i in range(70)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(bucket_edges) + 1)
+        self.n = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(bucket_edges, value)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Upper edge of the bucket containing the q-th percentile (0 <= q <= 100), at most the maximum"""
+        if self.n == 0:
+            return float('nan')
+        rank = q / 100 * self.n
+        cumulated = 0
+        for i, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= rank and count > 0:
+                return min(bucket_edges[i], self.max) if i < len(bucket_edges) else self.max
+        return self.max
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.queue_wait = Histogram()
+        self.bytes = 0
+        self.retries = 0
+        self.status = Counter()
+
+
+class RequestMetrics:
+    def __init__(self, callbacks=None, n_slowest=10):
+        """
+        :param list callbacks: functions called with a dict describing each request (keys: endpoint, url, status,
+            latency, queue_wait, bytes, retries), from the thread that sent the request
+        :param int n_slowest: number of slowest requests kept
+        """
+        self.callbacks = list(callbacks or [])
+        self.n_slowest = n_slowest
+        self.endpoints = defaultdict(EndpointMetrics)
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, url, status, latency, queue_wait=0, n_bytes=0, retries=0):
+        """Record a request, `status` is None if it failed without response (connection error, timeout)"""
+        with self.lock:
+            m = self.endpoints[endpoint]
+            m.latency.add(latency)
+            m.queue_wait.add(queue_wait)
+            m.bytes += n_bytes
+            m.retries += retries
+            m.status[status] += 1
+            heapq.heappush(self.slowest, (latency, url))
+            if len(self.slowest) > self.n_slowest:
+                heapq.heappop(self.slowest)
+
+        if self.callbacks:
+            event = dict(endpoint=endpoint, url=url, status=status, latency=latency,
+                         queue_wait=queue_wait, bytes=n_bytes, retries=retries)
+            for callback in self.callbacks:
+                callback(event)
+
+    def summary(self):
+        """pandas.DataFrame with one row per endpoint: number of requests, retries, MB received,
+        latency and queue wait percentiles (in ms, approximated by the histogram buckets), status codes"""
+        rows = {}
+        with self.lock:
+            for endpoint, m in self.endpoints.items():
+                row = {
+                    'requests': m.latency.n,
+                    'retries': m.retries,
+                    'MB': m.bytes / 2**20,
+                    'latency mean': 1000 * m.latency.total / m.latency.n,
+                }
+                for q in [50, 90, 99]:
+                    row[f'latency p{q}'] = 1000 * m.latency.percentile(q)
+                row['latency max'] = 1000 * m.latency.max
+                row['queue wait p50'] = 1000 * m.queue_wait.percentile(50)
+                row['queue wait p99'] = 1000 * m.queue_wait.percentile(99)
+                row.update({f'status {s}': n for s, n in sorted(m.status.items(), key=str)})
+                rows[endpoint] = row
+
+        return pd.DataFrame.from_dict(rows, orient='index').fillna(0)
+
+    def slowest_requests(self):
+        """List of (latency in seconds, url) of the slowest requests, slowest first"""
+        with self.lock:
+            return sorted(self.slowest, reverse=True)
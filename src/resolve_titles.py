@@ -0,0 +1,231 @@
+"""
+Resolve article titles with the MediaWiki action API, in batches: normalization (e.g. first letter in upper case),
+redirects, missing articles and language links (translations), instead of one wikipedia.search or wikipediaapi call
+per article.
+
+Up to `batch_size` (50, the limit of the API) titles are sent in a single query:
+
+    https://de.wikipedia.org/w/api.php?action=query&format=json&formatversion=2&redirects=1&prop=langlinks
+        &lllimit=max&titles=Datenschutz|DSGVO|...
+
+Results are cached on disk by (domain, title), one JSON line per title in `{cache}/{domain}.jsonl`, such that
+resolving a list again only queries the new titles:
+
+    {"title": "DSGVO", "resolved": "Datenschutz-Grundverordnung", "normalized": "DSGVO",
+     "redirect": "Datenschutz-Grundverordnung", "missing": false, "langlinks": {"en": "General Data Protection
+     Regulation"}, "langs": ["en"], "fetched": 1607712345.1}
+
+The transport (pooled connections, rate limiting, retries) is that of scrape_wiki.PageviewsClient. Test it against
+the stand-in server of fake_pageviews_api.py:
+
+    >>> server, root = fake_pageviews_api.serve()
+    >>> r = TitleResolver(contact, api_url=root + '/{domain}.wikipedia.org/w/api.php')
+"""
+
+import os
+import json
+import threading
+from time import time
+from urllib.parse import urlencode
+from scrape_wiki import PageviewsClient
+
+
+api_url = 'https://{domain}.wikipedia.org/w/api.php'
+
+# Maximum number of titles of a query, for clients without the apihighlimits right
+batch_size = 50
+
+# The action API is not meant to be hit by many parallel clients, ref: https://www.mediawiki.org/wiki/API:Etiquette
+parallelism = 2
+max_rate = 20
+
+
+def query_url(url, titles, langs=None, continuation=None):
+    """URL of a query resolving `titles`, with their language links to `langs` (a list, empty for none, or None for
+    all)"""
+    params = {'action': 'query', 'format': 'json', 'formatversion': 2, 'redirects': 1, 'titles': '|'.join(titles)}
+    if langs is None or len(langs) > 0:
+        params.update(prop='langlinks', lllimit='max')
+    if langs is not None and len(langs) == 1:
+        params['lllang'] = langs[0]
+    params.update(continuation or {})
+    return url + '?' + urlencode(params)
+
+
+def search_url(url, term, limit=1):
+    params = {
+        'action': 'query', 'format': 'json', 'formatversion': 2,
+        'list': 'search', 'srsearch': term, 'srlimit': limit, 'srprop': '',
+    }
+    return url + '?' + urlencode(params)
+
+
+def parse_query(response, titles, langs=None):
+    """Dict title -> cache entry of the `titles` of a query response, see the module docstring"""
+    query = response.get('query', {})
+    normalized = {n['from']: n['to'] for n in query.get('normalized', [])}
+    redirects = {r['from']: r['to'] for r in query.get('redirects', [])}
+    pages = {p['title']: p for p in query.get('pages', [])}
+
+    entries = {}
+    for title in titles:
+        current = normalized.get(title, title)
+        entry = {'title': title, 'normalized': current, 'redirect': None}
+        # Follow the redirects, at most once each in case of a loop
+        seen = {current}
+        while current in redirects and redirects[current] not in seen:
+            current = redirects[current]
+            seen.add(current)
+            entry['redirect'] = current
+
+        page = pages.get(current, {'missing': True})
+        entry['missing'] = bool(page.get('missing') or page.get('invalid'))
+        entry['resolved'] = None if entry['missing'] else current
+        entry['langlinks'] = {
+            link['lang']: link['title'] for link in page.get('langlinks', [])
+            if langs is None or link['lang'] in langs
+        }
+        entry['langs'] = sorted(langs) if langs is not None else ['*']
+        entry['fetched'] = time()
+        entries[title] = entry
+    return entries
+
+
+def merge_langlinks(response, other):
+    """Add the language links of the pages of the query response `other` (a continuation) to `response`"""
+    pages = {p['title']: p for p in response.get('query', {}).get('pages', [])}
+    for page in other.get('query', {}).get('pages', []):
+        if page['title'] in pages:
+            pages[page['title']].setdefault('langlinks', []).extend(page.get('langlinks', []))
+
+
+class TitleCache:
+    """Cache of the resolved titles of each domain, see the module docstring"""
+    def __init__(self, path):
+        """
+        :param str path: directory of the cache, created if needed
+        """
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def domain_path(self, domain):
+        return os.path.join(self.path, f'{domain}.jsonl')
+
+    def load(self, domain):
+        """Dict title -> entry of the domain, the last one written if a title was resolved several times"""
+        with self.lock:
+            if domain not in self.entries:
+                entries = {}
+                fp = self.domain_path(domain)
+                if os.path.exists(fp):
+                    with open(fp, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            # Interrupted while appending
+                            if line.endswith('\n'):
+                                entry = json.loads(line)
+                                entries[entry['title']] = entry
+                self.entries[domain] = entries
+            return self.entries[domain]
+
+    def get(self, domain, title, langs=None, max_age=None):
+        """Cached entry of the title, None if unknown, older than `max_age` seconds or without the language links
+        to `langs`"""
+        entry = self.load(domain).get(title)
+        if entry is None or (max_age is not None and time() - entry['fetched'] > max_age):
+            return None
+        if '*' not in entry['langs'] and (langs is None or not set(langs) <= set(entry['langs'])):
+            return None
+        return entry
+
+    def add(self, domain, entries):
+        self.load(domain)
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            with open(self.domain_path(domain), 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+            self.entries[domain].update((entry['title'], entry) for entry in entries)
+
+
+class TitleResolver:
+    def __init__(self, user_agent, api_url=api_url, cache=None, batch_size=batch_size, parallelism=parallelism,
+                 max_rate=max_rate, max_age=None, **kwargs):
+        """
+        :param str user_agent: User-Agent of the requests, should allow Wikimedia to contact you
+        :param str api_url: URL of the action API, `{domain}` is replaced by the domain (de, en, ...)
+        :param cache: directory (or TitleCache) of the cache, default: no cache
+        :param int batch_size: number of titles per query, at most 50
+        :param int parallelism: number of queries sent at the same time
+        :param float max_rate: maximum number of requests per second
+        :param float max_age: cached titles older than `max_age` seconds are resolved again, default: never
+        :param kwargs: other arguments of PageviewsClient (max_retries, timeout, metrics)
+        """
+        self.api_url = api_url
+        if cache is not None and not isinstance(cache, TitleCache):
+            cache = TitleCache(cache)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.client = PageviewsClient(user_agent, parallelism=parallelism, max_rate=max_rate, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.client.close()
+
+    def query(self, domain, titles, langs=None):
+        """Resolve a batch of titles, following the continuations of the language links"""
+        url = self.api_url.format(domain=domain)
+        response = self.client.get_json(query_url(url, titles, langs))
+        if 'error' in response:
+            raise ValueError(f'MediaWiki API error: {response["error"]}')
+        continuation = response.get('continue')
+        while continuation is not None:
+            other = self.client.get_json(query_url(url, titles, langs, continuation))
+            merge_langlinks(response, other)
+            continuation = other.get('continue')
+        return parse_query(response, titles, langs)
+
+    def resolve(self, titles, domain='de', langs=None):
+        """
+        Resolve `titles` of a domain, cached titles are not queried again
+        :param list titles: article titles, duplicates are resolved once
+        :param str domain: en, de, fr, ...
+        :param list langs: languages of the language links to get, default: none, '*' for all
+        :return: dict title -> entry, see the module docstring. `resolved` is None for missing articles.
+        """
+        langs = None if langs == '*' else list(langs or [])
+        titles = list(dict.fromkeys(titles))
+        entries = {}
+        pending = []
+        for title in titles:
+            entry = self.cache.get(domain, title, langs, self.max_age) if self.cache is not None else None
+            if entry is not None:
+                entries[title] = entry
+            else:
+                pending.append(title)
+
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        if batches:
+            print(f'Resolving {len(pending)} titles of {domain}.wikipedia in {len(batches)} queries '
+                  f'({len(entries)} cached)')
+        for _, result in self.client.imap_unordered(lambda batch: self.query(domain, batch, langs), batches):
+            entries.update(result)
+            if self.cache is not None:
+                self.cache.add(domain, list(result.values()))
+
+        return {title: entries[title] for title in titles}
+
+    def search(self, term, domain='de', n_results=1):
+        """Titles of the best `n_results` full-text search results of `term`, one query per term"""
+        response = self.client.get_json(search_url(self.api_url.format(domain=domain), term, n_results))
+        return [r['title'] for r in response.get('query', {}).get('search', [])]
+
+    def translate(self, titles, domain='de', lang='en'):
+        """Dict title -> title of the article in language `lang`, None if missing or without translation"""
+        entries = self.resolve(titles, domain, [lang])
+        return {title: entry['langlinks'].get(lang) for title, entry in entries.items()}
@@ -0,0 +1,184 @@
+"""
+Weekly and monthly rollups of the daily aggregates of the Parquet store (see dump_store.py), per (domain, article).
+
+Daily partitions are streamed one row group at a time and summed on integer article ids, a range of `chunk` ids at a
+time: memory is bounded by `--memory-mb`, whatever the number of articles and days. Rollups are stored next to the
+daily partitions, each period being identified by its first day (the Monday of weeks):
+
+    {path_store}/_rollups/granularity=monthly/domain=de/period=20150401/part.parquet   (article_id, views, days)
+    {path_store}/_rollups/granularity=monthly/domain=de/period=20150401/days.json      days summed in the rollup
+
+Runs are incremental: a period is only summed again if one of its days was added or rewritten since.
+
+Usage:
+    $ python3 src/rollup_dumps.py --granularity weekly,monthly --memory-mb 1024
+    >>> df = read_rollup('monthly', domains=['de'], articles=keywords)
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from datetime import datetime, timedelta
+from collections import defaultdict
+from time import time
+import dump_store
+from aggregate_dumps import keep_domains
+
+
+granularities = ['weekly', 'monthly']
+
+partitioning = ds.partitioning(pa.schema([('domain', pa.string()), ('period', pa.string())]), flavor='hive')
+
+
+def rollups_path(granularity, path=None):
+    return os.path.join(path or dump_store.path_store, '_rollups', f'granularity={granularity}')
+
+
+def period_path(granularity, domain, period, path=None):
+    return os.path.join(rollups_path(granularity, path), f'domain={domain}', f'period={period}')
+
+
+def period_start(day, granularity):
+    """First day ('YYYYMMDD') of the week or month of `day`"""
+    d = datetime.strptime(day, '%Y%m%d')
+    if granularity == 'monthly':
+        d = d.replace(day=1)
+    else:
+        d = d - timedelta(days=d.weekday())
+    return d.strftime('%Y%m%d')
+
+
+def load_period_record(granularity, domain, period, path=None):
+    """Dict day -> index stamp ('written') of the days summed in the rollup of the period, empty if not rolled up"""
+    fp = os.path.join(period_path(granularity, domain, period, path), 'days.json')
+    if not os.path.exists(fp):
+        return {}
+    with open(fp, 'r') as f:
+        return json.load(f)
+
+
+def get_pending_periods(granularity, domain, path=None):
+    """Dict period -> {day: written} of the periods with days added or rewritten since their rollup"""
+    periods = defaultdict(dict)
+    for day, entry in dump_store.load_index_entries(domain, path).items():
+        periods[period_start(day, granularity)][day] = entry['written']
+
+    return {
+        period: days for period, days in sorted(periods.items())
+        if load_period_record(granularity, domain, period, path) != days
+    }
+
+
+def rollup_period(granularity, domain, period, days, index, chunk, path=None):
+    """
+    Sum the views of the `days` of a period by article id and save the rollup
+    :param dict days: day -> index stamp of the days of the period
+    :param dict index: day -> row group bounds, see dump_store.load_index
+    :param int chunk: number of article ids summed at a time
+    """
+    n_ids = 1 + max((last for day in days for first, last in index[day]), default=-1)
+    files = {day: pq.ParquetFile(dump_store.partition_path(domain, day, path)) for day in days}
+
+    out_dir = period_path(granularity, domain, period, path)
+    os.makedirs(out_dir, exist_ok=True)
+    fp = os.path.join(out_dir, 'part.parquet')
+    schema = pa.schema([('article_id', pa.int32()), ('views', pa.int64()), ('days', pa.int16())])
+
+    # Write then rename, such that an interrupted run never leaves a truncated rollup
+    with pq.ParquetWriter(fp + '.tmp', schema, compression='zstd') as writer:
+        for lo in range(0, max(n_ids, 1), chunk):
+            hi = min(lo + chunk, n_ids)
+            totals = np.zeros(hi - lo, dtype=np.int64)
+            counts = np.zeros(hi - lo, dtype=np.int16)
+            for day, f in files.items():
+                # Row groups hold sorted ids, only those overlapping [lo, hi) are read
+                for i, (first, last) in enumerate(index[day]):
+                    if first >= hi or last < lo:
+                        continue
+                    table = f.read_row_group(i)
+                    ids = table.column('article_id').to_numpy()
+                    views = table.column('views').to_numpy()
+                    keep = (ids >= lo) & (ids < hi)
+                    # Ids are unique within a day, fancy indexing adds each of them once
+                    totals[ids[keep] - lo] += views[keep]
+                    counts[ids[keep] - lo] += 1
+
+            present = np.flatnonzero(counts)
+            writer.write_table(pa.table({
+                'article_id': pa.array(present + lo, pa.int32()),
+                'views': pa.array(totals[present], pa.int64()),
+                'days': pa.array(counts[present], pa.int16()),
+            }, schema=schema), row_group_size=dump_store.row_group_size)
+
+    os.replace(fp + '.tmp', fp)
+    with open(os.path.join(out_dir, 'days.json.tmp'), 'w') as f:
+        json.dump(days, f)
+    os.replace(os.path.join(out_dir, 'days.json.tmp'), os.path.join(out_dir, 'days.json'))
+
+
+def rollup(granularity, domains, memory_mb=1024, path=None):
+    """Roll up the periods of `domains` whose days changed"""
+    # Each id of a chunk takes 8 bytes of totals, 2 bytes of day counts and temporary masks and outputs
+    chunk = max(1, memory_mb * 2**20 // 24)
+    for domain in domains:
+        pending = get_pending_periods(granularity, domain, path)
+        print(f'{domain}: {len(pending)} {granularity} periods to roll up')
+        index = dump_store.load_index(domain, path)
+        for period, days in pending.items():
+            start = time()
+            rollup_period(granularity, domain, period, days, index, chunk, path)
+            print(f'Rolled up {granularity} {domain} {period} ({len(days)} days) in {time()-start:.4} s')
+
+
+def read_rollup(granularity, domains=None, periods=None, articles=None, path=None):
+    """
+    Load rollups as a pandas.DataFrame with columns domain, article, article_id, views, days (number of days with
+    views in the period) and period (first day of the period, 'YYYYMMDD')
+    :param str granularity: weekly or monthly
+    :param list domains: domains to load, default: all
+    :param list periods: periods to load, default: all
+    :param list articles: articles to load, default: all
+    """
+    dataset = ds.dataset(rollups_path(granularity, path), format='parquet', partitioning=partitioning,
+                         exclude_invalid_files=True)
+
+    expression = ds.scalar(True)
+    if domains is not None:
+        expression = expression & ds.field('domain').isin(list(domains))
+    if periods is not None:
+        expression = expression & ds.field('period').isin(list(periods))
+    if articles is not None:
+        # Each domain has its own ids
+        by_domain = ds.scalar(False)
+        for domain in domains if domains is not None else dump_store.partition_domains(path):
+            ids = list(dump_store.lookup_article_ids(domain, articles, path).values())
+            by_domain = by_domain | ((ds.field('domain') == domain) & ds.field('article_id').isin(ids))
+        expression = expression & by_domain
+
+    df = dataset.to_table(filter=expression).to_pandas()
+    df['domain'] = df.domain.astype(str)
+    df['period'] = df.period.astype(str)
+    return dump_store.add_article_names(df, path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--granularity', default='weekly,monthly',
+                        help=f'comma-separated among {", ".join(granularities)}')
+    parser.add_argument('--domains', default=','.join(keep_domains), help='comma-separated domains')
+    parser.add_argument('--memory-mb', type=int, default=1024,
+                        help='memory budget of the sums, bounds the number of article ids summed at a time')
+    args = parser.parse_args()
+
+    for granularity in args.granularity.split(','):
+        if granularity not in granularities:
+            raise ValueError(f'Unknown granularity {granularity}, must be one of {granularities}')
+        rollup(granularity, args.domains.split(','), args.memory_mb)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,38 @@ https://github.com/mediawiki-utilities/python-mwviews/blob/master/mwviews/api/pa
 
 import requests
 import traceback
+import random
+import threading
+import numpy as np
+import pandas as pd
+from requests.adapters import HTTPAdapter
 from requests.utils import quote
-from datetime import date, datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from collections import defaultdict
+from time import monotonic, sleep
+try:
+    from .pageviews_cache import PageviewsCache
+except ImportError:
+    # Imported as a top-level module, with src/ in sys.path
+    from pageviews_cache import PageviewsCache
 
-endpoints = {
-    'article': 'https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article',
-    'project': 'https://wikimedia.org/api/rest_v1/metrics/pageviews/aggregate',
-    'top': 'https://wikimedia.org/api/rest_v1/metrics/pageviews/top',
-}
+api_root = 'https://wikimedia.org/api/rest_v1/metrics/pageviews'
+
+
+def get_endpoints(root=api_root):
+    """Endpoints of the Pageviews API below `root` (override it to target a local stand-in server)"""
+    root = root.rstrip('/')
+    return {
+        'article': root + '/per-article',
+        'project': root + '/aggregate',
+        'top': root + '/top',
+    }
+
+
+endpoints = get_endpoints()
 
 
 def parse_date(stringDate):
@@ -38,8 +60,279 @@ def month_from_day(dt):
     return datetime(dt.year, dt.month, 1)
 
 
+def day_start(d):
+    return datetime(d.year, d.month, d.day)
+
+
+def months_between(start, end):
+    """First day of every month overlapping the range start-end"""
+    month = month_from_day(start)
+    while month <= end:
+        yield month
+        month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def output_timestamps(granularity, startDate, endDate):
+    """Timestamps of the time series returned by the API (hourly, daily or monthly)"""
+    if granularity == 'monthly':
+        return months_between(startDate, endDate)
+    if granularity == 'hourly':
+        return timestamps_between(startDate, endDate, timedelta(hours=1))
+    return timestamps_between(day_start(startDate), endDate, timedelta(days=1))
+
+
+def as_datetime(d):
+    """Convert a datetime.date or a string in YYYYMMDD[HH] format to datetime"""
+    if isinstance(d, datetime):
+        return d
+    if isinstance(d, date):
+        return day_start(d)
+    return parse_date(d)
+
+
+def make_session(user_agent, pool_size):
+    """Create a session keeping up to `pool_size` keep-alive connections open per host,
+    so that concurrent workers reuse TCP/TLS connections instead of opening one per request"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': user_agent})
+    return session
+
+
+# Wikimedia asks clients to stay below 200 requests/s, ref: https://wikimedia.org/api/rest_v1/
+max_rate = 200
+# Responses worth retrying, the other errors (e.g. 404 when there is no data) are final
+retry_status = {429, 500, 502, 503, 504}
+backoff_base = 0.5
+backoff_max = 60
+
+
+class TokenBucket:
+    """Limit the rate of requests sent to a host. The rate is halved each time the host throttles us (429)
+    and slowly increased back to `rate` after successful requests (additive increase, multiplicative decrease)."""
+
+    def __init__(self, rate, min_rate=1):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.tokens = rate
+        self.last = monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, return the number of seconds to wait before sending the request"""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - 1
+            self.last = now
+            return max(0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, monotonic() + retry_after)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+
+
+def parse_retry_after(value):
+    """Seconds to wait according to a Retry-After header (delay in seconds or HTTP date), None if absent"""
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None):
+    """Exponential backoff with jitter, at least `retry_after` seconds if the server asked for it"""
+    delay = min(backoff_max, backoff_base * 2 ** attempt) * random.uniform(0.5, 1)
+    return max(delay, retry_after or 0)
+
+
+class RequestError(Exception):
+    def __init__(self, url, status):
+        super().__init__(f'HTTP {status} at {url}')
+        self.url = url
+        self.status = status
+
+
+def parse_range(start, end):
+    """Convert `start` and `end` arguments of the client methods to datetimes, see PageviewsClient.article_views"""
+    endDate = as_datetime(end or date.today())
+    startDate = as_datetime(start) if start else endDate - timedelta(30)
+    return startDate, endDate
+
+
+def article_url(endpoints, project, article, access, agent, granularity, startDate, endDate):
+    return '/'.join([
+        endpoints['article'], project, access, agent, quote(article, safe=''), granularity,
+        format_date(startDate), format_date(endDate),
+    ])
+
+
+def article_urls(endpoints, project, articles, access, agent, granularity, startDate, endDate):
+    """Return the normalized article names and the per-article URLs to request"""
+    # If the user passes in a string as "articles", convert to a list
+    if type(articles) is str:
+        articles = [articles]
+
+    articles = [a.replace(' ', '_') for a in articles]
+
+    urls = [
+        article_url(endpoints, project, a, access, agent, granularity, startDate, endDate)
+        for a in articles
+    ]
+    return articles, urls
+
+
+def article_output(articles, granularity, startDate, endDate):
+    """Empty output of PageviewsClient.article_views, every view count set to None"""
+    outputDays = output_timestamps(granularity, startDate, endDate)
+    return defaultdict(dict, {
+        day: {a: None for a in articles} for day in outputDays
+    })
+
+
+def project_urls(endpoints, projects, access, agent, granularity, startDate, endDate):
+    return [
+        '/'.join([
+            endpoints['project'], p, access, agent, granularity,
+            format_date(startDate), format_date(endDate),
+        ])
+        for p in projects
+    ]
+
+
+def project_output(projects, granularity, startDate, endDate):
+    """Empty output of PageviewsClient.project_views, every view count set to None"""
+    outputDays = output_timestamps(granularity, startDate, endDate)
+    return defaultdict(dict, {
+        day: {p: None for p in projects} for day in outputDays
+    })
+
+
+def fill_output(output, results, key, urls):
+    """Write the view counts of the API `results` into `output`, `key` is the item field
+    identifying the time series ('article' or 'project')"""
+    some_data_returned = False
+    for result in results:
+        if 'items' in result:
+            some_data_returned = True
+        else:
+            continue
+        for item in result['items']:
+            output[parse_date(item['timestamp'])][item[key]] = item['views']
+
+    if not some_data_returned:
+        raise Exception(
+            'The pageview API returned nothing useful at: {}'.format(urls)
+        )
+    return output
+
+
+def output_index(granularity, startDate, endDate):
+    """Timestamps of the rows of the columnar outputs, same as output_timestamps"""
+    if granularity == 'hourly':
+        return pd.date_range(startDate, endDate, freq=timedelta(hours=1))
+    if granularity == 'monthly':
+        return pd.date_range(month_from_day(startDate), endDate, freq='MS')
+    return pd.date_range(day_start(startDate), endDate, freq=timedelta(days=1))
+
+
+# Largest integer below which every view count is exact in float32
+float32_exact = 2**24
+
+
+def columnar_output(results, granularity, startDate, endDate, urls, dtype=None):
+    """Fill a (timestamps x results) matrix, NaN where no data is available, with the view counts of the API
+    `results`. Timestamps are converted all at once instead of item by item.
+    The matrix is float32 by default, float64 if a count is above `float32_exact` (e.g. a monthly series of a popular
+    article) such that counts stay exact, or of the given `dtype`."""
+    index = output_index(granularity, startDate, endDate)
+
+    timestamps, views, columns = [], [], []
+    for i, result in enumerate(results):
+        if 'items' not in result:
+            continue
+        items = result['items']
+        timestamps.extend(item['timestamp'] for item in items)
+        views.extend(item['views'] for item in items)
+        columns.append(np.full(len(items), i))
+
+    if len(columns) == 0:
+        raise Exception(
+            'The pageview API returned nothing useful at: {}'.format(urls)
+        )
+
+    views = np.array(views, dtype=np.int64)
+    if dtype is None:
+        dtype = np.float32 if len(views) == 0 or views.max() <= float32_exact else np.float64
+    matrix = np.full((len(index), len(results)), np.nan, dtype=dtype)
+    rows = index.get_indexer(pd.to_datetime(np.array(timestamps), format='%Y%m%d%H'))
+    columns = np.concatenate(columns)
+    # Timestamps outside of the requested range are dropped
+    inside = rows >= 0
+    matrix[rows[inside], columns[inside]] = views[inside]
+    return index, matrix
+
+
+output_formats = ['dict', 'array', 'frame']
+
+
+def assemble_output(results, key, names, granularity, startDate, endDate, urls, output_format):
+    """Format the API `results` of the time series `names` as requested by `output_format`,
+    see PageviewsClient.article_views"""
+    if output_format == 'dict':
+        empty_output = article_output if key == 'article' else project_output
+        output = empty_output(names, granularity, startDate, endDate)
+        return fill_output(output, results, key, urls)
+
+    # Views of whole projects are far above float32_exact
+    dtype = np.float64 if key == 'project' else None
+    index, matrix = columnar_output(results, granularity, startDate, endDate, urls, dtype)
+    if output_format == 'array':
+        return index.values, matrix
+    return pd.DataFrame(matrix, index=index, columns=names)
+
+
+def check_output_format(output_format):
+    if output_format not in output_formats:
+        raise ValueError(f'output_format must be one of {output_formats}, got "{output_format}"')
+
+
+def top_url(endpoints, project, access, year, month, day):
+    yesterday = date.today() - timedelta(days=1)
+    year = str(year or yesterday.year)
+    month = str(month or yesterday.month).rjust(2, '0')
+    day = str(day or yesterday.day).rjust(2, '0')
+
+    return '/'.join([endpoints['top'], project, access, year, month, day])
+
+
+def top_from_result(result, limit):
+    """Sorted list of top articles from an API result, None if the result has no ranking"""
+    if 'items' in result and len(result['items']) == 1:
+        r = result['items'][0]['articles']
+        r.sort(key=lambda x: x['rank'])
+        return r[0:(limit)]
+    return None
+
+
 class PageviewsClient:
-    def __init__(self, user_agent, parallelism=10):
+    def __init__(self, user_agent, parallelism=10, api_root=None, cache=None,
+                 max_rate=max_rate, max_retries=5, timeout=30, metrics=None):
         """
         Create a PageviewsClient
         :Parameters:
@@ -48,16 +341,57 @@ class PageviewsClient:
                          need be, ref:
                          https://www.mediawiki.org/wiki/REST_API
             parallelism : The number of parallel threads to use when making
-                          multiple requests to the API at the same time
+                          multiple requests to the API at the same time, the
+                          pool of keep-alive connections has the same size
+            api_root : root URL of the Pageviews API, default: wikimedia.org
+            cache : directory (or PageviewsCache) where article_views keeps the
+                    time series it fetched, only the days missing from the
+                    cache are then requested, default: no cache
+            max_rate : maximum number of requests per second sent to each host,
+                       lowered automatically when the API throttles us (HTTP 429),
+                       None to disable rate limiting
+            max_retries : number of times a request is retried after a connection
+                          error, a timeout, HTTP 429 or 5xx, with exponential backoff
+                          (honouring the Retry-After header)
+            timeout : timeout of each request, in seconds
+            metrics : RequestMetrics recording latency, size, status, retries and
+                      queue wait of every request, default: no instrumentation
         """
 
         self.headers = {"User-Agent": user_agent}
         self.parallelism = parallelism
+        self.endpoints = get_endpoints(api_root) if api_root else endpoints
+        # Connections and worker threads are shared by all the calls of the client
+        self.session = make_session(user_agent, parallelism)
+        self.executor = None
+        if cache is not None and not isinstance(cache, PageviewsCache):
+            cache = PageviewsCache(cache)
+        self.cache = cache
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limiters = {}
+        self.rate_limiters_lock = threading.Lock()
+        self.metrics = metrics
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the worker threads and close pooled connections"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.session.close()
 
     def article_views(
             self, project, articles,
             access='all-access', agent='all-agents', granularity='daily',
-            start=None, end=None):
+            start=None, end=None, output_format='dict', partial=False):
         """
         Get pageview counts for one or more articles
         See `<https://wikimedia.org/api/rest_v1/metrics/pageviews/?doc\\
@@ -78,8 +412,19 @@ class PageviewsClient:
                 can be a datetime.date object or string in YYYYMMDD format
                 default: 30 days before end date
             granularity : str
-                can be daily or monthly
+                can be daily or monthly, monthly series are aggregated by the API
+                (about 30 times fewer data points), keyed by the first day of each month
                 default: daily
+            output_format : str
+                dict: nested dictionary described below (default)
+                array: tuple (timestamps, matrix), matrix is a float32 numpy array (float64 if a count
+                       is above 2**24, see columnar_output) of shape (len(timestamps), len(articles)),
+                       NaN where no data is available
+                frame: pandas.DataFrame of the same matrix with timestamps as index and articles as columns
+            partial : bool
+                if True, articles whose requests still fail after all retries do not make
+                the whole call fail, the call then returns a tuple (output, failed_articles)
+                default: False
         :Returns:
             a nested dictionary that looks like: {
                 start_date: {
@@ -99,51 +444,25 @@ class PageviewsClient:
             The view_count will be None where no data is available, to distinguish from 0
         TODO: probably doesn't handle unicode perfectly, look into it
         """
-        endDate = end or date.today()
-        if type(endDate) is not date:
-            endDate = parse_date(end)
-
-        startDate = start or endDate - timedelta(30)
-        if type(startDate) is not date:
-            startDate = parse_date(start)
-
-        # If the user passes in a string as "articles", convert to a list
-        if type(articles) is str:
-            articles = [articles]
-
-        articles = [a.replace(' ', '_') for a in articles]
-        articlesSafe = [quote(a, safe='') for a in articles]
-
-        urls = [
-            '/'.join([
-                endpoints['article'], project, access, agent, a, granularity,
-                format_date(startDate), format_date(endDate),
-            ])
-            for a in articlesSafe
-        ]
-
-        outputDays = timestamps_between(startDate, endDate, timedelta(days=1))
-        if granularity == 'monthly':
-            outputDays = list(set([month_from_day(day) for day in outputDays]))
-        output = defaultdict(dict, {
-            day: {a: None for a in articles} for day in outputDays
-        })
+        check_output_format(output_format)
+        startDate, endDate = parse_range(start, end)
+        articles, urls = article_urls(
+            self.endpoints, project, articles, access, agent, granularity, startDate, endDate)
 
         try:
-            results = self.get_concurrent(urls)
-            some_data_returned = False
-            for result in results:
-                if 'items' in result:
-                    some_data_returned = True
-                else:
-                    continue
-                for item in result['items']:
-                    output[parse_date(item['timestamp'])][item['article']] = item['views']
-            if not some_data_returned:
-                raise Exception(
-                    'The pageview API returned nothing useful at: {}'.format(urls)
-                )
-
+            if self.cache is None:
+                results = self.get_concurrent(urls, partial=partial)
+            else:
+                results = self.get_cached(
+                    project, articles, access, agent, granularity, startDate, endDate, partial=partial)
+
+            # Failed requests are None
+            failed = [a for a, result in zip(articles, results) if result is None]
+            results = [result or {} for result in results]
+            output = assemble_output(
+                results, 'article', articles, granularity, startDate, endDate, urls, output_format)
+            if partial:
+                return output, failed
             return output
         except:
             print('ERROR while fetching and parsing ' + str(urls))
@@ -153,7 +472,7 @@ class PageviewsClient:
     def project_views(
             self, projects,
             access='all-access', agent='all-agents', granularity='daily',
-            start=None, end=None):
+            start=None, end=None, output_format='dict'):
         """
         Get pageview counts for one or more wikimedia projects
         See `<https://wikimedia.org/api/rest_v1/metrics/pageviews/?doc\\
@@ -174,6 +493,8 @@ class PageviewsClient:
             start : str|date
                 can be a datetime.date object or string in YYYYMMDDHH format
                 default: 30 days before end date
+            output_format : str
+                dict (default), array or frame, see article_views, the matrix is float64
         :Returns:
             a nested dictionary that looks like: {
                 start_date: {
@@ -192,55 +513,76 @@ class PageviewsClient:
             }
             The view_count will be None where no data is available, to distinguish from 0
         """
-        endDate = end or date.today()
-        if type(endDate) is not date:
-            endDate = parse_date(end)
-
-        startDate = start or endDate - timedelta(30)
-        if type(startDate) is not date:
-            startDate = parse_date(start)
-
-        urls = [
-            '/'.join([
-                endpoints['project'], p, access, agent, granularity,
-                format_date(startDate), format_date(endDate),
-            ])
-            for p in projects
-        ]
-
-        if granularity == 'hourly':
-            increment = timedelta(hours=1)
-        elif granularity == 'daily':
-            increment = timedelta(days=1)
-        elif granularity == 'monthly':
-            increment = timedelta(months=1)
-
-        outputDays = timestamps_between(startDate, endDate, increment)
-        output = defaultdict(dict, {
-            day: {p: None for p in projects} for day in outputDays
-        })
+        check_output_format(output_format)
+        startDate, endDate = parse_range(start, end)
+        urls = project_urls(
+            self.endpoints, projects, access, agent, granularity, startDate, endDate)
 
         try:
             results = self.get_concurrent(urls)
-            some_data_returned = False
-            for result in results:
-                if 'items' in result:
-                    some_data_returned = True
-                else:
-                    continue
-                for item in result['items']:
-                    output[parse_date(item['timestamp'])][item['project']] = item['views']
-
-            if not some_data_returned:
-                raise Exception(
-                    'The pageview API returned nothing useful at: {}'.format(urls)
-                )
-            return output
+            return assemble_output(
+                results, 'project', projects, granularity, startDate, endDate, urls, output_format)
         except:
             print('ERROR while fetching and parsing ' + str(urls))
             traceback.print_exc()
             raise
 
+    def iter_article_views(
+            self, project, articles,
+            access='all-access', agent='all-agents', granularity='daily',
+            start=None, end=None, output_format='dict', partial=False, max_in_flight=None):
+        """
+        Same as article_views, but yield the time series of each article as soon as it is fetched,
+        such that memory does not grow with the number of articles.
+        :Parameters:
+            articles : iterable of str, consumed lazily
+            output_format : str
+                dict: {timestamp: view_count} (None where no data is available)
+                array: tuple (timestamps, float32 vector), float64 if a count is above 2**24
+                frame: pandas.Series of the same vector indexed by timestamps
+            partial : bool
+                if True, articles whose requests still fail after all retries are
+                yielded with None instead of raising
+            max_in_flight : int
+                maximum number of articles requested at the same time
+                default: twice `parallelism`
+            see article_views for the other parameters
+        :Returns:
+            a generator of (article, time_series) tuples, in order of completion
+        """
+        check_output_format(output_format)
+        startDate, endDate = parse_range(start, end)
+
+        def fetch(article):
+            try:
+                if self.cache is None:
+                    return self.get_json(
+                        article_url(self.endpoints, project, article, access, agent, granularity, startDate, endDate))
+                return self.get_cached_article(project, article, access, agent, granularity, startDate, endDate)
+            except (requests.RequestException, RequestError, ValueError) as e:
+                if not partial:
+                    raise
+                print(f'ERROR while fetching {article}: {e}')
+                return None
+
+        articles = (a.replace(' ', '_') for a in articles)
+        for article, result in self.imap_unordered(fetch, articles, max_in_flight):
+            if result is None:
+                yield article, None
+                continue
+            if 'items' not in result:
+                # No data at all for this article
+                result = {'items': []}
+
+            output = assemble_output(
+                [result], 'article', [article], granularity, startDate, endDate, None, output_format)
+            if output_format == 'dict':
+                yield article, {day: views[article] for day, views in output.items()}
+            elif output_format == 'array':
+                yield article, (output[0], output[1][:, 0])
+            else:
+                yield article, output[article]
+
     def top_articles(
             self, project, access='all-access',
             year=None, month=None, day=None, limit=1000):
@@ -273,20 +615,12 @@ class PageviewsClient:
                 ...
             ]
         """
-        yesterday = date.today() - timedelta(days=1)
-        year = str(year or yesterday.year)
-        month = str(month or yesterday.month).rjust(2, '0')
-        day = str(day or yesterday.day).rjust(2, '0')
-
-        url = '/'.join([endpoints['top'], project, access, year, month, day])
+        url = top_url(self.endpoints, project, access, year, month, day)
 
         try:
-            result = requests.get(url, headers=self.headers).json()
-
-            if 'items' in result and len(result['items']) == 1:
-                r = result['items'][0]['articles']
-                r.sort(key=lambda x: x['rank'])
-                return r[0:(limit)]
+            r = top_from_result(self.get_json(url), limit)
+            if r is not None:
+                return r
         except:
             print('ERROR while fetching or parsing ' + url)
             traceback.print_exc()
@@ -296,8 +630,239 @@ class PageviewsClient:
             'The pageview API returned nothing useful at: {}'.format(url)
         )
 
-    def get_concurrent(self, urls):
-        with ThreadPoolExecutor(self.parallelism) as executor:
-            f = lambda url: requests.get(url, headers=self.headers).json()
-            return list(executor.map(f, urls))
+    def top_articles_range(
+            self, project, start=None, end=None, limit=1000,
+            access='all-access', granularity='daily'):
+        """
+        Get the top articles of every day (or month) between `start` and `end`, fetched concurrently.
+        Rankings are read from the cache when the client has one.
+        :Parameters:
+            project : str
+                a wikimedia project such as en.wikipedia or commons.wikimedia
+            start, end : str|date
+                see article_views
+            limit : int
+                number of top articles kept per day (or month)
+                default : 1000
+            access : str
+                see top_articles
+            granularity : str
+                daily, or monthly for the rankings of whole months
+                default: daily
+        :Returns:
+            a pandas.DataFrame with columns article, views, rank, date, language,
+            periods without data in the API are missing
+        """
+        startDate, endDate = parse_range(start, end)
+        if granularity == 'monthly':
+            periods = pd.date_range(month_from_day(startDate), endDate, freq='MS')
+        else:
+            periods = pd.date_range(day_start(startDate), endDate, freq=timedelta(days=1))
+
+        def fetch(period):
+            year, month = str(period.year), str(period.month).rjust(2, '0')
+            day = 'all-days' if granularity == 'monthly' else str(period.day).rjust(2, '0')
+
+            if self.cache is not None:
+                ranking = self.cache.load_top(project, access, year, month, day)
+                if ranking is not None:
+                    return ranking
+
+            url = top_url(self.endpoints, project, access, year, month, day)
+            try:
+                ranking = top_from_result(self.get_json(url), None)
+            except (requests.RequestException, RequestError, ValueError) as e:
+                print(f'ERROR while fetching {url}: {e}')
+                return None
+            if ranking is not None and self.cache is not None:
+                self.cache.save_top(ranking, project, access, year, month, day)
+            return ranking
+
+        articles, views, ranks, dates, missing = [], [], [], [], []
+        for period, ranking in self.imap_unordered(fetch, periods):
+            if ranking is None:
+                missing.append(period)
+                continue
+            ranking = ranking[0:limit]
+            articles.extend(r['article'] for r in ranking)
+            views.extend(r['views'] for r in ranking)
+            ranks.extend(r['rank'] for r in ranking)
+            dates.append(np.full(len(ranking), period.to_datetime64()))
+
+        if len(missing) > 0:
+            print(f'<WARNING> no ranking for {len(missing)} periods, e.g. {min(missing).date()}')
+
+        df = pd.DataFrame({
+            'article': articles,
+            'views': np.array(views, dtype=np.int64),
+            'rank': np.array(ranks, dtype=np.int32),
+            'date': np.concatenate(dates) if dates else np.array([], dtype='datetime64[ns]'),
+        })
+        df['language'] = project.split('.')[0]
+        return df.sort_values(['date', 'rank'], ignore_index=True)
+
+    def get_cached(self, project, articles, access, agent, granularity, startDate, endDate, partial=False):
+        """Same as get_concurrent for article requests, but only fetch the date ranges missing from the cache.
+        Articles without any data (error responses) are not cached and are requested again on the next call."""
+        keys = [(project, a, access, agent, granularity) for a in articles]
+        entries = [self.cache.load(*key) for key in keys]
+
+        # One request per article and missing date range
+        missing = [
+            (i, day_start(s), day_start(e))
+            for i, entry in enumerate(entries)
+            for s, e in self.cache.missing_ranges(entry, startDate, endDate, granularity)
+        ]
+        urls = [
+            article_url(self.endpoints, project, articles[i], access, agent, granularity, s, e)
+            for i, s, e in missing
+        ]
+        updated, failed = set(), set()
+        for (i, s, e), result in zip(missing, self.get_concurrent(urls, partial=partial)):
+            if result is None:
+                failed.add(i)
+            elif 'items' in result:
+                self.cache.add(entries[i], s, e, result['items'], granularity)
+                updated.add(i)
+
+        for i in updated:
+            self.cache.save(entries[i], *keys[i])
+
+        return [
+            None if i in failed else self.cache.result(entry, a, startDate, endDate, granularity)
+            for i, (a, entry) in enumerate(zip(articles, entries))
+        ]
+
+    def get_cached_article(self, project, article, access, agent, granularity, startDate, endDate):
+        """Fetch the date ranges of a single article missing from the cache, one after the other,
+        and return its result from the cache, see get_cached"""
+        key = (project, article, access, agent, granularity)
+        entry = self.cache.load(*key)
+
+        updated = False
+        for s, e in self.cache.missing_ranges(entry, startDate, endDate, granularity):
+            s, e = day_start(s), day_start(e)
+            result = self.get_json(
+                article_url(self.endpoints, project, article, access, agent, granularity, s, e))
+            if 'items' in result:
+                self.cache.add(entry, s, e, result['items'], granularity)
+                updated = True
+
+        if updated:
+            self.cache.save(entry, *key)
+        return self.cache.result(entry, article, startDate, endDate, granularity)
+
+    def rate_limiter(self, url):
+        """Token bucket of the host of `url`, None if rate limiting is disabled"""
+        if self.max_rate is None:
+            return None
+        host = urlparse(url).netloc
+        with self.rate_limiters_lock:
+            if host not in self.rate_limiters:
+                self.rate_limiters[host] = TokenBucket(self.max_rate)
+            return self.rate_limiters[host]
+
+    def endpoint_name(self, url):
+        for name, prefix in self.endpoints.items():
+            if url.startswith(prefix + '/'):
+                return name
+        return urlparse(url).netloc
+
+    def get_json(self, url):
+        """GET `url` and decode the JSON response, retry on connection errors, timeouts, HTTP 429 and 5xx"""
+        begin = monotonic()
+        # Time spent in the thread pool queue (see run_queued), then waiting for the rate limiter
+        queued_at = getattr(self.local, 'queued_at', None)
+        self.local.queued_at = None
+        pool_wait = 0 if queued_at is None else begin - queued_at
+        limiter_wait, status, n_bytes, attempt = 0, None, 0, 0
+
+        limiter = self.rate_limiter(url)
+        try:
+            for attempt in range(self.max_retries + 1):
+                if limiter is not None:
+                    wait_time = limiter.reserve()
+                    limiter_wait += wait_time
+                    sleep(wait_time)
+
+                retry_after, status = None, None
+                try:
+                    r = self.session.get(url, timeout=self.timeout)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                else:
+                    status, n_bytes = r.status_code, len(r.content)
+                    if r.status_code not in retry_status:
+                        if limiter is not None:
+                            limiter.succeeded()
+                        return r.json()
+                    error = RequestError(url, r.status_code)
+                    retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                    if r.status_code == 429 and limiter is not None:
+                        limiter.throttled(retry_after)
+
+                if attempt < self.max_retries:
+                    sleep(retry_delay(attempt, retry_after))
+            raise error
+        finally:
+            if self.metrics is not None:
+                # Latency includes retries and their backoff, but not the rate limiter
+                latency = monotonic() - begin - limiter_wait
+                self.metrics.record(
+                    self.endpoint_name(url), url, status, latency, pool_wait + limiter_wait, n_bytes, attempt)
+
+    def run_queued(self, f, item, queued_at):
+        """Run f(item) in a worker thread, telling get_json when the task was submitted"""
+        self.local.queued_at = queued_at
+        try:
+            return f(item)
+        finally:
+            self.local.queued_at = None
+
+    def get_concurrent(self, urls, partial=False):
+        """Fetch all `urls` in parallel, results are in the same order as `urls`.
+        With `partial`, requests failing after all retries give None instead of raising."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.parallelism)
+
+        f = self.get_json
+        if partial:
+            def f(url):
+                try:
+                    return self.get_json(url)
+                except (requests.RequestException, RequestError, ValueError) as e:
+                    print(f'ERROR while fetching {url}: {e}')
+                    return None
+
+        queued_at = monotonic()
+        return list(self.executor.map(lambda url: self.run_queued(f, url, queued_at), urls))
+
+    def imap_unordered(self, f, iterable, max_in_flight=None):
+        """Yield (item, f(item)) for each item of `iterable`, in order of completion, running in the thread pool.
+        At most `max_in_flight` items are submitted at once, such that `iterable` is consumed lazily."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.parallelism)
+        max_in_flight = max_in_flight or 2 * self.parallelism
+
+        iterator = iter(iterable)
+        in_flight = {}
+
+        def submit():
+            for item in iterator:
+                in_flight[self.executor.submit(self.run_queued, f, item, monotonic())] = item
+                return
+
+        try:
+            for _ in range(max_in_flight):
+                submit()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    submit()
+                    yield item, future.result()
+        finally:
+            # The consumer stopped early or a request failed: drop the requests not started yet
+            for future in in_flight:
+                future.cancel()
 
@@ -0,0 +1,187 @@
+"""
+asyncio variant of scrape_wiki.PageviewsClient, based on aiohttp.
+
+A single event loop keeps hundreds of requests in flight over a shared pool of keep-alive connections,
+which is much cheaper than one thread per concurrent request. Usage:
+
+    async with AsyncPageviewsClient(contact, parallelism=200) as p:
+        res = await p.article_views('de.wikipedia', articles, start='20150701', end='20190531')
+"""
+
+import asyncio
+import traceback
+import aiohttp
+from time import monotonic
+from urllib.parse import urlparse
+from scrape_wiki import (
+    get_endpoints, endpoints, parse_range, article_urls, project_urls, assemble_output, check_output_format,
+    top_url, top_from_result, max_rate, retry_status, TokenBucket, RequestError, parse_retry_after, retry_delay
+)
+
+
+class AsyncPageviewsClient:
+    def __init__(self, user_agent, parallelism=100, api_root=None,
+                 max_rate=max_rate, max_retries=5, timeout=30, metrics=None):
+        """
+        Create an AsyncPageviewsClient, it must be used as an async context manager (or closed with `close`)
+        :Parameters:
+            user_agent : User-Agent string to use for HTTP requests, see PageviewsClient
+            parallelism : maximum number of requests in flight (and of open connections) at the same time
+            api_root : root URL of the Pageviews API, default: wikimedia.org
+            max_rate, max_retries, timeout : rate limiting and retries, see PageviewsClient
+            metrics : RequestMetrics, see PageviewsClient, the queue wait only counts the rate limiter here,
+                      waiting for a free connection is part of the latency
+        """
+        self.headers = {"User-Agent": user_agent}
+        self.parallelism = parallelism
+        self.endpoints = get_endpoints(api_root) if api_root else endpoints
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limiters = {}
+        self.metrics = metrics
+        self.session = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.parallelism, limit_per_host=self.parallelism)
+            self.session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def article_views(
+            self, project, articles,
+            access='all-access', agent='all-agents', granularity='daily',
+            start=None, end=None, output_format='dict', partial=False):
+        """Coroutine version of PageviewsClient.article_views, same parameters and output"""
+        check_output_format(output_format)
+        startDate, endDate = parse_range(start, end)
+        articles, urls = article_urls(
+            self.endpoints, project, articles, access, agent, granularity, startDate, endDate)
+
+        try:
+            results = await self.get_concurrent(urls, partial=partial)
+            failed = [a for a, result in zip(articles, results) if result is None]
+            results = [result or {} for result in results]
+            output = assemble_output(
+                results, 'article', articles, granularity, startDate, endDate, urls, output_format)
+            if partial:
+                return output, failed
+            return output
+        except:
+            print('ERROR while fetching and parsing ' + str(urls))
+            traceback.print_exc()
+            raise
+
+    async def project_views(
+            self, projects,
+            access='all-access', agent='all-agents', granularity='daily',
+            start=None, end=None, output_format='dict'):
+        """Coroutine version of PageviewsClient.project_views, same parameters and output"""
+        check_output_format(output_format)
+        startDate, endDate = parse_range(start, end)
+        urls = project_urls(
+            self.endpoints, projects, access, agent, granularity, startDate, endDate)
+
+        try:
+            results = await self.get_concurrent(urls)
+            return assemble_output(
+                results, 'project', projects, granularity, startDate, endDate, urls, output_format)
+        except:
+            print('ERROR while fetching and parsing ' + str(urls))
+            traceback.print_exc()
+            raise
+
+    async def top_articles(
+            self, project, access='all-access',
+            year=None, month=None, day=None, limit=1000):
+        """Coroutine version of PageviewsClient.top_articles, same parameters and output"""
+        url = top_url(self.endpoints, project, access, year, month, day)
+
+        try:
+            r = top_from_result(await self.get_json(url), limit)
+            if r is not None:
+                return r
+        except:
+            print('ERROR while fetching or parsing ' + url)
+            traceback.print_exc()
+            raise
+
+        raise Exception(
+            'The pageview API returned nothing useful at: {}'.format(url)
+        )
+
+    def rate_limiter(self, url):
+        if self.max_rate is None:
+            return None
+        host = urlparse(url).netloc
+        if host not in self.rate_limiters:
+            self.rate_limiters[host] = TokenBucket(self.max_rate)
+        return self.rate_limiters[host]
+
+    async def get_json(self, url):
+        """See PageviewsClient.get_json"""
+        self.open()
+        begin = monotonic()
+        limiter_wait, status, n_bytes, attempt = 0, None, 0, 0
+
+        limiter = self.rate_limiter(url)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            for attempt in range(self.max_retries + 1):
+                if limiter is not None:
+                    wait_time = limiter.reserve()
+                    limiter_wait += wait_time
+                    await asyncio.sleep(wait_time)
+
+                retry_after, status = None, None
+                try:
+                    async with self.session.get(url, timeout=timeout) as r:
+                        status = r.status
+                        body = await r.read()
+                        n_bytes = len(body)
+                        if r.status not in retry_status:
+                            if limiter is not None:
+                                limiter.succeeded()
+                            # The API answers errors with a JSON body too, whatever the content type
+                            return await r.json(content_type=None)
+                        error = RequestError(url, r.status)
+                        retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                        if r.status == 429 and limiter is not None:
+                            limiter.throttled(retry_after)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    error = e
+
+                if attempt < self.max_retries:
+                    await asyncio.sleep(retry_delay(attempt, retry_after))
+            raise error
+        finally:
+            if self.metrics is not None:
+                latency = monotonic() - begin - limiter_wait
+                name = next((n for n, prefix in self.endpoints.items() if url.startswith(prefix + '/')),
+                            urlparse(url).netloc)
+                self.metrics.record(name, url, status, latency, limiter_wait, n_bytes, attempt)
+
+    async def get_concurrent(self, urls, partial=False):
+        """See PageviewsClient.get_concurrent"""
+        async def f(url):
+            try:
+                return await self.get_json(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RequestError, ValueError) as e:
+                if not partial:
+                    raise
+                print(f'ERROR while fetching {url}: {e}')
+                return None
+
+        # The connector limits the number of simultaneous connections to `parallelism`
+        return await asyncio.gather(*(f(url) for url in urls))
@@ -9,3 +9,9 @@ params = {
     'end':   '20190531'  # 31th May 2019
 }
 
+# On-disk cache of the time series fetched by PageviewsClient (paths relative to the root folder of the project)
+cache_path = 'data/cache/pageviews'
+
+
+# On-disk cache of the article titles resolved by update_keywords.search (see resolve_titles.py)
+titles_cache_path = 'data/cache/titles'
@@ -0,0 +1,177 @@
+"""
+Generator of synthetic hourly pagecounts dumps, shaped like the real ones, to test and benchmark the dump pipeline
+(see bench_pipeline.py) without the real dumps of `download_dumps.path_data`.
+
+Each hour has at most one line `domain article views bytes` per (domain, article), sorted by domain and article.
+Page requests are drawn from a Zipf-like distribution of the articles, the same in every hour, and from a Zipf-like
+distribution of the domains (en, de, ja, ... then made-up small domains), such that most lines have 1 view and a few
+articles have many. A fraction of the lines is malformed like in the real dumps:
+
+    - article names with a space, i.e. 5 fields
+    - empty article names or views
+    - views that are not an integer
+    - article names that are not valid UTF-8
+
+and a fraction of the article names contain unbalanced double quotes.
+
+Usage:
+    $ python3 src/synth_dumps.py /tmp/dumps 20150401 20150402 --lines 1000000 --articles 2000000
+"""
+
+import os
+import gzip
+import hashlib
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from download_dumps import generate_download_links, generate_time_range
+
+
+# Largest domains of the real dumps, in decreasing order of size
+real_domains = [
+    'en', 'ja', 'de', 'es', 'ru', 'fr', 'it', 'commons.m', 'pl', 'zh', 'pt', 'en.m', 'nl', 'sv', 'tr', 'ar', 'fa',
+    'ko', 'cs', 'uk', 'id', 'he', 'fi', 'hu', 'vi', 'no', 'ro', 'da', 'th', 'ca',
+]
+
+words = ['Geschichte', 'List_of', 'Datenschutz', '%C3%89cole', 'Bahnhof', 'The', 'Liste_der', 'Saison', 'Film',
+         'Special:Search', 'Wikipedia:Hauptseite', 'Main_Page', '%E6%97%A5%E6%9C%AC', 'File:Logo.svg']
+
+
+def get_domains(n_domains):
+    """`n_domains` domains, the real ones first then made-up ones"""
+    return real_domains[:n_domains] + [f'x{i}' for i in range(n_domains - len(real_domains))]
+
+
+def get_articles(n_articles):
+    """Article names, by decreasing popularity"""
+    return [f'{words[i % len(words)]}_{i}'.encode('utf-8') for i in range(n_articles)]
+
+
+def zipf_ranks(rng, n, n_values, a):
+    """`n` ranks in [0, n_values) drawn from a Zipf distribution of exponent `a`"""
+    return (rng.zipf(a, n) - 1) % n_values
+
+
+class DumpGenerator:
+    def __init__(self, n_lines=1000000, n_articles=2000000, n_domains=50, zipf_articles=1.2, zipf_domains=1.1,
+                 malformed_rate=1e-5, quoted_rate=1e-4, seed=0):
+        """
+        :param int n_lines: number of page requests per hour, the number of lines is smaller since requests of the
+            same article are summed
+        :param int n_articles: number of distinct articles per domain
+        :param int n_domains: number of domains, see get_domains
+        :param float zipf_articles: exponent of the Zipf distribution of the articles, > 1
+        :param float zipf_domains: exponent of the Zipf distribution of the domains, > 1
+        :param float malformed_rate: fraction of malformed lines
+        :param float quoted_rate: fraction of article names with a double quote
+        """
+        self.n_lines = n_lines
+        self.zipf_articles = zipf_articles
+        self.zipf_domains = zipf_domains
+        self.malformed_rate = malformed_rate
+        self.quoted_rate = quoted_rate
+        self.seed = seed
+        self.domains = np.array([d.encode('utf-8') for d in get_domains(n_domains)], dtype=object)
+        # Rank of each domain in alphabetical order, lines are sorted by domain name
+        self.domain_order = np.argsort(np.argsort(self.domains))
+        self.articles = np.array(get_articles(n_articles), dtype=object)
+
+    def hour_lines(self, hour):
+        """Content of the dump file of the `hour`-th hour, as bytes"""
+        rng = np.random.default_rng([self.seed, hour])
+        domains = zipf_ranks(rng, self.n_lines, len(self.domains), self.zipf_domains)
+        articles = zipf_ranks(rng, self.n_lines, len(self.articles), self.zipf_articles)
+
+        # One line per (domain, article), its views are the number of requests
+        n_articles = len(self.articles)
+        keys, views = np.unique(self.domain_order[domains] * n_articles + articles, return_counts=True)
+        domains = np.sort(self.domains)[keys // n_articles]
+        articles = self.articles[keys % n_articles]
+        views_str = views.astype(str).astype(object)
+        sizes = (views * rng.integers(5000, 50000, len(views))).astype(str).astype(object)
+
+        quoted = np.flatnonzero(rng.random(len(articles)) < self.quoted_rate)
+        for i in quoted:
+            articles[i] = articles[i] + b'_"' if i % 2 else b'"' + articles[i]
+
+        malformed = np.flatnonzero(rng.random(len(articles)) < self.malformed_rate)
+        for i, kind in zip(malformed, rng.integers(0, 5, len(malformed))):
+            if kind == 0:
+                articles[i] = articles[i].replace(b'_', b' ') + b' x'
+            elif kind == 1:
+                articles[i] = b''
+            elif kind == 2:
+                views_str[i] = ''
+            elif kind == 3:
+                views_str[i] = f'{views[i]}.0'
+            else:
+                articles[i] = articles[i] + b'\xff\xfe'
+
+        lines = pc.binary_join_element_wise(
+            pa.array(domains, pa.binary()), pa.array(articles, pa.binary()),
+            pa.array([v.encode('ascii') for v in views_str], pa.binary()),
+            pa.array([s.encode('ascii') + b'\n' for s in sizes], pa.binary()),
+            b' ')
+        # The values of a binary array are contiguous: the lines of the file
+        offsets = np.frombuffer(lines.buffers()[1], dtype=np.int32)
+        return lines.buffers()[2].to_pybytes()[offsets[lines.offset]:offsets[lines.offset + len(lines)]]
+
+    def write(self, fp, hour, compresslevel=6):
+        content = self.hour_lines(hour)
+        tmp = fp + '.tmp'
+        with gzip.open(tmp, 'wb', compresslevel=compresslevel) as f:
+            f.write(content)
+        os.replace(tmp, fp)
+        return content.count(b'\n')
+
+
+def generate_dumps(path, start, end, generator=None, hours=24, compresslevel=6):
+    """
+    Write the synthetic dump files of the days `start` to `end` (YYYYMMDD, included) in `path`, the first `hours`
+    hours of each day, and their md5sums.txt. Existing files are kept.
+    :return: dict file name -> number of lines
+    """
+    generator = generator or DumpGenerator()
+    os.makedirs(path, exist_ok=True)
+    links = dict(generate_download_links(start, end))
+    lines = {}
+    for i, (date, fname) in enumerate(zip(generate_time_range(start, end), links)):
+        if date.hour >= hours:
+            continue
+        fp = os.path.join(path, fname)
+        if os.path.exists(fp):
+            continue
+        lines[fname] = generator.write(fp, i, compresslevel)
+        print(f'Generated {fname}: {lines[fname]} lines')
+
+    with open(os.path.join(path, 'md5sums.txt'), 'w') as f:
+        for fname in sorted(os.listdir(path)):
+            if fname.startswith('pagecounts-') and fname.endswith('.gz'):
+                with open(os.path.join(path, fname), 'rb') as dump:
+                    f.write(f'{hashlib.md5(dump.read()).hexdigest()}  {fname}\n')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='output directory')
+    parser.add_argument('start', help='first day, YYYYMMDD')
+    parser.add_argument('end', help='last day, YYYYMMDD')
+    parser.add_argument('--hours', type=int, default=24, help='number of hours per day')
+    parser.add_argument('--lines', type=int, default=1000000, help='number of page requests per hour')
+    parser.add_argument('--articles', type=int, default=2000000, help='number of articles per domain')
+    parser.add_argument('--domains', type=int, default=50, help='number of domains')
+    parser.add_argument('--malformed-rate', type=float, default=1e-5, help='fraction of malformed lines')
+    parser.add_argument('--quoted-rate', type=float, default=1e-4, help='fraction of article names with a quote')
+    parser.add_argument('--compresslevel', type=int, default=6, help='gzip compression level')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generator = DumpGenerator(args.lines, args.articles, args.domains, malformed_rate=args.malformed_rate,
+                              quoted_rate=args.quoted_rate, seed=args.seed)
+    generate_dumps(args.path, args.start, args.end, generator, args.hours, args.compresslevel)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,12 @@ Usage:
         $ python3 src/update_keywords.py <keyword-list-name>_template.txt <wiki-domain>
     3. Carefully review the output
     4. A file containing keywords reported in output is created
+
+The mapping keyword -> article name is kept next to the output file (<keyword-list-name>_<domain>_mapping.json).
+Later runs only look up the keywords that were added or changed in the template, and `--fetch` downloads the
+pageviews of the articles that are not in the dataset of the list yet (e.g. GDPR for data/GDPR_template.txt, see
+fetch_dataset and dataset_store.py), removing the articles no longer in the output. `--refresh` looks up every
+keyword again.
 """
 
 
@@ -13,10 +19,9 @@ import os
 import argparse
 from setup import *
 from scrape_wiki import PageviewsClient
-import pandas as pd
-import numpy as np
-import wikipedia as wiki
-from concurrent.futures import ThreadPoolExecutor
+from resolve_titles import TitleResolver, api_url
+import dataset_store
+import json
 import pathlib
 import datetime
 
@@ -42,49 +47,114 @@ def read_keywords(fname):
     return data
 
 
-def request(articles, domain='de', **kwargs):
+def request(articles, domain='de', listname=None, **kwargs):
     """Wraps the function PageviewsClient.article_views
 
     :param list[str] articles: list of articles names (must match perfectly with Wikipedia article names)
     :param str domain: en, fr, ...
+    :param str listname: if given, the pageviews are also added to the dataset of the list in `domain`, see
+        dataset_store.py, e.g. request(keywords, 'de', 'GDPR') then dataset_store.load('GDPR', 'de')
     :param kwargs: any argument provided to
     :return:
     """
     wrapped_kwargs = params.copy()
     wrapped_kwargs.update(kwargs)
+    language = domain
     domain = domain + '.wikipedia'
 
-    # Fetch
-    p = PageviewsClient(contact)
-    res = p.article_views(articles=articles, project=domain, **wrapped_kwargs)
+    # Fetch, days already downloaded by previous calls are read from the cache
+    with PageviewsClient(contact, cache=cache_path) as p:
+        # Results come as a DataFrame (dates x articles), NaN where no data is available
+        res = p.article_views(articles=articles, project=domain, output_format='frame', **wrapped_kwargs)
 
-    # Format results in a DataFrame
-    res = pd.DataFrame(res).T
-    # Replace None -> np.nan
-    res = res.applymap(lambda elem: np.nan if elem is None else elem)
     # Sort by dates
     res.sort_index(inplace=True)
 
+    if listname is not None:
+        start, end = wrapped_kwargs['start'], wrapped_kwargs['end']
+        n_rows = dataset_store.upsert(res, listname, language, start, end, wrapped_kwargs.get('granularity', 'daily'))
+        print(f'{n_rows} new rows in the dataset {listname} ({language})')
+
     return res
 
 
-def search(articles, n_results=1, n_threads=10):
-    """Wraps wikipedia.search function to find exact article names.
+def search(articles, domain='de', n_results=1, resolver=None):
+    """Find exact article names: titles are resolved in batches (normalization, redirects, see resolve_titles.py),
+    only the articles that do not exist are looked up with a full-text search.
 
     :param list[str] articles:
+    :param str domain: en, fr, ...
     :param int n_results: number of suggestions returned per article
-    :param int n_threads: number of parallel threads to run
+    :param TitleResolver resolver: default: a new one, caching titles in `titles_cache_path`
     :return: dict[int, list], key is article name provided in argument, list is suggestions returned by API
     """
-    with ThreadPoolExecutor(n_threads) as executor:
-        f = lambda article: wiki.search(article, results=n_results)
-        res = list(executor.map(f, articles))
-
-    for article, ls in zip(articles, res):
-        if len(ls) == 0:
+    resolver = resolver or TitleResolver(contact, cache=titles_cache_path)
+    entries = resolver.resolve(articles, domain)
+
+    res = {}
+    for article in articles:
+        if entries[article]['resolved'] is not None:
+            res[article] = [entries[article]['resolved']]
+        else:
+            res[article] = resolver.search(article, domain, n_results)
+        if len(res[article]) == 0:
             print(f'Warning! Article {article} has no suggestions.')
 
-    return dict(zip(articles, res))
+    return res
+
+
+def resolve_keywords(keywords, domain='de', resolver=None):
+    """Look up the article names of `keywords` with search, along with how they were found
+
+    :return: dict keyword -> {'title': article name or None, 'method': 'title' (the keyword is an article or redirects
+        to one), 'search' (full-text search) or 'none', 'redirect': redirect target or None, 'resolved_at': date}
+    """
+    resolver = resolver or TitleResolver(contact, cache=titles_cache_path)
+    suggestions = search(keywords, domain, n_results=1, resolver=resolver)
+    # Read from the cache of the resolver
+    entries = resolver.resolve(keywords, domain)
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+
+    mapping = {}
+    for k in keywords:
+        if entries[k]['resolved'] is not None:
+            method = 'title'
+        else:
+            method = 'search' if suggestions[k] else 'none'
+        mapping[k] = {
+            'title': suggestions[k][0] if suggestions[k] else None,
+            'method': method,
+            'redirect': entries[k]['redirect'],
+            'resolved_at': now,
+        }
+    return mapping
+
+
+def get_mapping_filename(outfile):
+    path = pathlib.Path(outfile)
+    return str(path.with_name(path.stem + '_mapping.json'))
+
+
+def load_mapping(fname, domain):
+    """Mapping keyword -> metadata saved by a previous run for `domain`, see resolve_keywords. Empty if none."""
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'r', encoding='utf-8') as f:
+        saved = json.load(f)
+    if saved.get('domain') != domain:
+        return {}
+    return saved['keywords']
+
+
+def save_mapping(fname, domain, mapping):
+    with open(fname + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'domain': domain, 'keywords': mapping}, f, ensure_ascii=False, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+
+def read_output_titles(outfile):
+    """Article names of a previous output file, empty if none"""
+    return read_keywords(outfile) if os.path.exists(outfile) else []
 
 
 def main():
@@ -92,6 +162,13 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('template', help='file containing newline-delimited keywords, filename pattern: *_template*')
     parser.add_argument('domain', help='wikipedia domain/project (en, de, fr, ...)')
+    parser.add_argument('--api-url', default=api_url,
+                        help='MediaWiki action API, {domain} is replaced by the domain, e.g. fake_pageviews_api.py')
+    parser.add_argument('--refresh', action='store_true',
+                        help='look up every keyword again, not only those added or changed since the last run')
+    parser.add_argument('--fetch', action='store_true',
+                        help='add the pageviews of the articles of the output file to the dataset of the list, '
+                             'see fetch_dataset')
     args = parser.parse_args()
 
     if not os.path.exists(args.template):
@@ -100,28 +177,40 @@ def main():
         raise ValueError('The keywords file must end with `_template`')
 
     # ------ Setup
-    wiki.set_rate_limiting(rate_limit=True)
-    wiki.set_lang(args.domain)
+    resolver = TitleResolver(contact, api_url=args.api_url, cache=titles_cache_path)
 
     # ------ Load keywords from file
     keywords = read_keywords(args.template)
     print(f'Loaded {len(keywords)} keywords')
-    #print(keywords)
-    #print(get_output_filename(args.template, args.domain))
-    #exit()
+    outfile = get_output_filename(args.template, args.domain)
+    mapping_file = get_mapping_filename(outfile)
+
+    # ------ Compare with the previous run
+    previous = load_mapping(mapping_file, args.domain)
+    # Keywords without article are looked up again, e.g. the article may have been created since
+    pending = list(dict.fromkeys(
+        k for k in keywords if args.refresh or k not in previous or previous[k]['title'] is None))
+    removed = [k for k in previous if k not in set(keywords)]
+    print(f'{len(pending)} keywords to look up, {len(keywords) - len(pending)} unchanged, {len(removed)} removed')
 
     # ------ Fetch suggestions
-    print('Fetching suggestions...')
-    r = search(keywords, n_results=1)
-    r = {key: value[0] for key, value in r.items()}
+    mapping = {k: previous[k] for k in keywords if k in previous}
+    if pending:
+        print('Fetching suggestions...')
+        mapping.update(resolve_keywords(pending, args.domain, resolver))
+    r = {k: mapping[k]['title'] for k in keywords if mapping[k]['title'] is not None}
+    changed = {k: r[k] for k in pending if k in r and previous.get(k, {}).get('title') != r[k]}
 
     # ------ Review
-    print(f'Whole mapping:')
-    pretty_print_dic(r)
+    print(f'New or changed mapping:')
+    pretty_print_dic(changed)
+    if removed:
+        print(f'Removed keywords:')
+        pretty_print_dic({k: previous[k]['title'] for k in removed})
 
     print('\nBelow is a more readable report (exact matches are not reported):')
     case_mismatch, no_match = {}, {}
-    for k , val in r.items():
+    for k , val in changed.items():
         if k == val:
             continue
         if k.lower() == val.lower():
@@ -134,13 +223,44 @@ def main():
     print(f'No match:')
     pretty_print_dic(no_match)
 
-    # Write
-    final_keywords = '\n'.join(r.values())
-    outfile = get_output_filename(args.template, args.domain)
-    header = get_header()
-    with open(outfile, 'w') as f:
-        f.write(header + final_keywords)
-    print(f'Written in file {outfile}')
+    # Write, only if the list of articles changed
+    previous_titles = read_output_titles(outfile)
+    titles = list(r.values())
+    save_mapping(mapping_file, args.domain, {k: mapping[k] for k in keywords})
+    if titles == previous_titles:
+        print(f'{outfile} is up to date')
+    else:
+        final_keywords = '\n'.join(titles)
+        header = get_header()
+        with open(outfile + '.tmp', 'w') as f:
+            f.write(header + final_keywords)
+        os.replace(outfile + '.tmp', outfile)
+        print(f'Written in file {outfile}')
+
+    # ------ Pageviews of the articles missing from the dataset, e.g. new ones
+    if args.fetch:
+        fetch_dataset(titles, args.domain, get_listname(outfile, args.domain))
+
+
+def fetch_dataset(titles, domain, listname):
+    """Add the pageviews of the articles `titles` that are not in the dataset of the list yet (see dataset_store.py),
+    and remove those of the articles no longer in the list, e.g. whose keyword was removed or now maps to another
+    article: the dataset holds the articles of the output file only."""
+    # Article names of the dataset, as returned by request
+    articles = [t.replace(' ', '_') for t in titles]
+    granularity = params.get('granularity', 'daily')
+    missing = dataset_store.missing_articles(articles, listname, domain, params['start'], params['end'], granularity)
+    if missing:
+        print(f'Fetching pageviews of {len(missing)} articles into the dataset {listname}...')
+        request(missing, domain, listname)
+    else:
+        print(f'The dataset {listname} ({domain}) is up to date')
+
+    stale = set(dataset_store.load_fetched(listname, domain, granularity)) - set(articles)
+    if stale:
+        n_rows = dataset_store.remove_articles(stale, listname, domain, granularity)
+        print(f'Removed {len(stale)} articles no longer in the list from the dataset {listname} ({n_rows} rows): '
+              f'{sorted(stale)}')
 
 
 def pretty_print_dic(dic):
@@ -164,6 +284,14 @@ def get_output_filename(template_fname, language):
     return outfile
 
 
+def get_listname(outfile, language):
+    """Name of the keyword list of an output file, e.g. GDPR for data/GDPR_de.txt, see dataset_store.py"""
+    listname = pathlib.Path(outfile).stem
+    if listname.endswith(f'_{language}'):
+        listname = listname[:-len(language) - 1]
+    return listname
+
+
 def get_header():
     now = datetime.datetime.now()
     h = f"""